@@ -13,6 +13,12 @@ class Settings:
     HUBSPOT_CLIENT_ID = os.getenv("HUBSPOT_CLIENT_ID", "")
     HUBSPOT_CLIENT_SECRET = os.getenv("HUBSPOT_CLIENT_SECRET", "")
     HUBSPOT_REFRESH_TOKEN = os.getenv("HUBSPOT_REFRESH_TOKEN", "")
+    # Renew the access token this many seconds before it expires (background task)
+    HUBSPOT_TOKEN_RENEW_MARGIN = float(os.getenv("HUBSPOT_TOKEN_RENEW_MARGIN", "300"))
+    HUBSPOT_TOKEN_RETRY_DELAY = float(os.getenv("HUBSPOT_TOKEN_RETRY_DELAY", "10"))
+    # Token store shared by all workers on the node: "file" (default) or "memory" (per process)
+    HUBSPOT_TOKEN_STORE = os.getenv("HUBSPOT_TOKEN_STORE", "file")
+    HUBSPOT_TOKEN_STORE_PATH = os.getenv("HUBSPOT_TOKEN_STORE_PATH", ".hubspot_token.json")
     
     # Developer Credentials (for Channel Registration)
     HUBSPOT_DEVELOPER_API_KEY = os.getenv("HUBSPOT_DEVELOPER_API_KEY", "")
@@ -24,6 +30,121 @@ class Settings:
     
     # Custom Property Internal Names
     PROP_LANDBOT_ID = "landbot_customer_id"
+    # How often to re-check that PROP_LANDBOT_ID exists (seconds)
+    HUBSPOT_PROPERTY_PROBE_INTERVAL = float(os.getenv("HUBSPOT_PROPERTY_PROBE_INTERVAL", "600"))
+
+    # Upstream Base URLs (overridden to point at local stand-ins, e.g. by src/scripts/bench_pipeline.py)
+    HUBSPOT_API_URL = os.getenv("HUBSPOT_API_URL", "https://api.hubapi.com").rstrip("/")
+    LANDBOT_API_URL = os.getenv("LANDBOT_API_URL", "https://api.landbot.io").rstrip("/")
+
+    # Upstream Connection Pools (one long-lived pool per API)
+    HUBSPOT_MAX_CONNECTIONS = int(os.getenv("HUBSPOT_MAX_CONNECTIONS", "100"))
+    HUBSPOT_MAX_KEEPALIVE = int(os.getenv("HUBSPOT_MAX_KEEPALIVE", "20"))
+    HUBSPOT_KEEPALIVE_EXPIRY = float(os.getenv("HUBSPOT_KEEPALIVE_EXPIRY", "60"))
+    HUBSPOT_HTTP2 = os.getenv("HUBSPOT_HTTP2", "true").lower() == "true"
+    HUBSPOT_CONNECT_TIMEOUT = float(os.getenv("HUBSPOT_CONNECT_TIMEOUT", "3"))
+    HUBSPOT_READ_TIMEOUT = float(os.getenv("HUBSPOT_READ_TIMEOUT", "10"))
+
+    LANDBOT_MAX_CONNECTIONS = int(os.getenv("LANDBOT_MAX_CONNECTIONS", "50"))
+    LANDBOT_MAX_KEEPALIVE = int(os.getenv("LANDBOT_MAX_KEEPALIVE", "10"))
+    LANDBOT_KEEPALIVE_EXPIRY = float(os.getenv("LANDBOT_KEEPALIVE_EXPIRY", "60"))
+    LANDBOT_HTTP2 = os.getenv("LANDBOT_HTTP2", "false").lower() == "true"
+    LANDBOT_CONNECT_TIMEOUT = float(os.getenv("LANDBOT_CONNECT_TIMEOUT", "3"))
+    LANDBOT_READ_TIMEOUT = float(os.getenv("LANDBOT_READ_TIMEOUT", "10"))
+
+    # Circuit Breakers (per upstream)
+    CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+    CIRCUIT_RECOVERY_TIMEOUT = float(os.getenv("CIRCUIT_RECOVERY_TIMEOUT", "30"))
+    CIRCUIT_HALF_OPEN_MAX_CALLS = int(os.getenv("CIRCUIT_HALF_OPEN_MAX_CALLS", "1"))
+
+    # Rate Limits (initial budgets: max calls per interval in seconds; resized from response headers)
+    HUBSPOT_RATE_LIMIT_MAX = float(os.getenv("HUBSPOT_RATE_LIMIT_MAX", "100"))
+    HUBSPOT_RATE_LIMIT_INTERVAL = float(os.getenv("HUBSPOT_RATE_LIMIT_INTERVAL", "10"))
+    HUBSPOT_SEARCH_RATE_LIMIT_MAX = float(os.getenv("HUBSPOT_SEARCH_RATE_LIMIT_MAX", "4"))
+    HUBSPOT_SEARCH_RATE_LIMIT_INTERVAL = float(os.getenv("HUBSPOT_SEARCH_RATE_LIMIT_INTERVAL", "1"))
+    LANDBOT_RATE_LIMIT_MAX = float(os.getenv("LANDBOT_RATE_LIMIT_MAX", "10"))
+    LANDBOT_RATE_LIMIT_INTERVAL = float(os.getenv("LANDBOT_RATE_LIMIT_INTERVAL", "1"))
+    # How long a call may queue for budget before failing
+    RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "10"))
+
+    # Retries (jittered exponential backoff, seconds)
+    RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "4"))
+    RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5"))
+    RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "8"))
+    # A message is given up (dead-lettered) this many seconds after it was received
+    MESSAGE_DEADLINE = float(os.getenv("MESSAGE_DEADLINE", "600"))
+    IDEMPOTENCY_DB = os.getenv("IDEMPOTENCY_DB", "idempotency.db")
+    IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "86400"))
+
+    # Contact Resolution Cache (Landbot ID / phone -> HubSpot Contact ID)
+    CONTACT_CACHE_SIZE = int(os.getenv("CONTACT_CACHE_SIZE", "10000"))
+    CONTACT_CACHE_TTL = float(os.getenv("CONTACT_CACHE_TTL", "86400"))
+    CONTACT_CACHE_DB = os.getenv("CONTACT_CACHE_DB", "")  # e.g. "contact_cache.db" to survive restarts
+    # Cache misses are resolved in batches of HubSpot calls (size 1 = one by one). Misses arriving
+    # while a batch runs wait for it to finish and go out together; when idle, a miss waits at most
+    # the window for others (0 = none). Claimed outbox jobs join batches before a consumer runs them.
+    CONTACT_BATCH_WINDOW = float(os.getenv("CONTACT_BATCH_WINDOW", "0"))
+    CONTACT_BATCH_SIZE = int(os.getenv("CONTACT_BATCH_SIZE", "100"))
+    # Country calling code assumed for phones without one, e.g. "34" (Spain)
+    PHONE_DEFAULT_COUNTRY_CODE = os.getenv("PHONE_DEFAULT_COUNTRY_CODE", "").lstrip("+")
+    # Preload recently active contacts with a Landbot ID at startup, then every interval (0 = startup only)
+    CONTACT_WARMUP = os.getenv("CONTACT_WARMUP", "false").lower() == "true"
+    CONTACT_WARMUP_INTERVAL = float(os.getenv("CONTACT_WARMUP_INTERVAL", "3600"))
+    # Each contact takes two cache entries (Landbot ID and phone)
+    CONTACT_WARMUP_MAX = int(os.getenv("CONTACT_WARMUP_MAX", str(CONTACT_CACHE_SIZE // 2)))
+
+    # Thread -> Ticket association state (bounded, in-memory)
+    THREAD_STATE_SIZE = int(os.getenv("THREAD_STATE_SIZE", "10000"))
+
+    # Deferred Ticket Lookups (seconds; retried with exponential backoff until the deadline)
+    TICKET_LOOKUP_INITIAL_DELAY = float(os.getenv("TICKET_LOOKUP_INITIAL_DELAY", "5"))
+    TICKET_LOOKUP_MAX_DELAY = float(os.getenv("TICKET_LOOKUP_MAX_DELAY", "60"))
+    TICKET_LOOKUP_DEADLINE = float(os.getenv("TICKET_LOOKUP_DEADLINE", "300"))
+    TICKET_LOOKUP_MAX_PENDING = int(os.getenv("TICKET_LOOKUP_MAX_PENDING", "10000"))
+    TICKET_LOOKUP_BATCH_SIZE = int(os.getenv("TICKET_LOOKUP_BATCH_SIZE", "50"))
+
+    # Durable Outbox (SQLite WAL queue between webhooks and upstream calls)
+    OUTBOX_DB = os.getenv("OUTBOX_DB", "outbox.db")
+    OUTBOX_CONSUMERS = int(os.getenv("OUTBOX_CONSUMERS", "8"))
+    OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+    OUTBOX_FLUSH_INTERVAL = float(os.getenv("OUTBOX_FLUSH_INTERVAL", "0.002"))
+    OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "1.0"))
+    OUTBOX_MAX_PENDING = int(os.getenv("OUTBOX_MAX_PENDING", "100000"))
+    OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+    OUTBOX_VISIBILITY_TIMEOUT = float(os.getenv("OUTBOX_VISIBILITY_TIMEOUT", "300"))
+
+    # Logging: JSON lines to a rotating file, written by a background thread
+    LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+    LOG_FILE = os.getenv("LOG_FILE", "debug_webhooks.log")  # empty = console only
+    LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # "json" or "text"
+    LOG_ROTATE_BYTES = int(os.getenv("LOG_ROTATE_BYTES", str(10 * 1024 * 1024)))  # 0 = leave rotation to logrotate
+    LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN", "")  # e.g. "midnight" to rotate by time instead of size
+    LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+    # Keep 1 in N of httpx's per-request INFO lines
+    LOG_HTTPX_SAMPLE_EVERY = int(os.getenv("LOG_HTTPX_SAMPLE_EVERY", "20"))
+
+    # Tracing: comma-separated span exporters, "memory" (served at /debug/traces) and/or "jsonl"
+    TRACE_EXPORTERS = os.getenv("TRACE_EXPORTERS", "")
+    TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+    TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "5000"))  # spans kept by the memory exporter
+
+    # Admin endpoints (/admin/profile, /debug/traces): Bearer token; empty disables them
+    ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+    PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+    # Event loop monitor: warn with the blocking stack when the loop stalls longer than the threshold (0 = off)
+    LOOP_MONITOR_INTERVAL = float(os.getenv("LOOP_MONITOR_INTERVAL", "0.1"))
+    LOOP_BLOCK_THRESHOLD = float(os.getenv("LOOP_BLOCK_THRESHOLD", "0.25"))
+
+    # Webhook Deduplication (seconds a delivered message id is remembered)
+    DEDUP_TTL = float(os.getenv("DEDUP_TTL", "3600"))
+    # Window for messages that carry neither an id nor a timestamp (content hash only)
+    DEDUP_CONTENT_TTL = float(os.getenv("DEDUP_CONTENT_TTL", "30"))
+    DEDUP_MEMORY_SIZE = int(os.getenv("DEDUP_MEMORY_SIZE", "100000"))
+
+    # Message Debounce: merge a customer's burst of Landbot messages into one HubSpot
+    # message. Seconds of quiet that close a burst; 0 disables it.
+    LANDBOT_DEBOUNCE_WINDOW = float(os.getenv("LANDBOT_DEBOUNCE_WINDOW", "0"))
+    LANDBOT_DEBOUNCE_MAX_WAIT = float(os.getenv("LANDBOT_DEBOUNCE_MAX_WAIT", "10"))
 
     @classmethod
     def validate(cls):
@@ -0,0 +1,159 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+from src.config import settings
+from src.services.tracing import current_trace_id
+
+# Attributes every LogRecord has; anything else was passed through `extra=` and goes into the JSON line
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName"}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+class LazyJson:
+    """
+    Log argument serialized only when the line is actually written, on the
+    logging thread: logger.debug("Payload: %s", LazyJson(payload)).
+    Pass a callable to also defer building the value.
+    """
+    __slots__ = ("value",)
+
+    def __init__(self, value: Any):
+        self.value = value
+
+    def __str__(self) -> str:
+        value = self.value() if callable(self.value) else self.value
+        return json.dumps(value, default=str, ensure_ascii=False)
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line: time, level, logger, message, plus any `extra=` fields.
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and key != "sample_every":
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep only one in N records of a noisy line: the first, then every Nth.
+
+    N comes from `extra={"sample_every": N}` at the call site, or from a
+    per-logger rate (e.g. httpx request lines). Warnings and errors are never
+    sampled. Kept records carry `sampled: N`.
+    """
+    def __init__(self, logger_rates: Dict[str, int]):
+        super().__init__()
+        self.logger_rates = logger_rates
+        self._seen: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        every = getattr(record, "sample_every", None) or self.logger_rates.get(record.name)
+        if not every or every <= 1:
+            return True
+        # The unformatted template identifies the call site
+        key = (record.name, record.msg)
+        with self._lock:
+            seen = self._seen[key]
+            self._seen[key] = seen + 1
+        if seen % every:
+            return False
+        record.sampled = every
+        return True
+
+class TraceFilter(logging.Filter):
+    """
+    Tag records logged while handling a message with its trace (correlation) ID.
+    Runs in the logging caller, where the trace context is visible.
+    """
+    def filter(self, record: logging.LogRecord) -> bool:
+        trace_id = current_trace_id()
+        if trace_id:
+            record.trace_id = trace_id
+        return True
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Leave message formatting (and LazyJson serialization) to the listener thread;
+        # only render the traceback now, while its frames are still alive.
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def _file_handler() -> logging.Handler:
+    """
+    Size or time rotation done by this process, or none (LOG_ROTATE_BYTES=0): with
+    several uvicorn workers on one file, in-process rotation renames the file under
+    the other workers and loses lines, so rotate with logrotate instead. The watched
+    handler reopens the file once logrotate has moved it.
+    """
+    if settings.LOG_ROTATE_WHEN:
+        return logging.handlers.TimedRotatingFileHandler(
+            settings.LOG_FILE, when=settings.LOG_ROTATE_WHEN, backupCount=settings.LOG_BACKUP_COUNT, encoding="utf-8"
+        )
+    if settings.LOG_ROTATE_BYTES <= 0:
+        return logging.handlers.WatchedFileHandler(settings.LOG_FILE, encoding="utf-8")
+    return logging.handlers.RotatingFileHandler(
+        settings.LOG_FILE, maxBytes=settings.LOG_ROTATE_BYTES, backupCount=settings.LOG_BACKUP_COUNT, encoding="utf-8"
+    )
+
+def setup_logging():
+    """
+    Route all logging through a queue: callers only enqueue the record, and a
+    background thread formats it and writes the rotating log file and the console.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    text_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handlers = []
+    if settings.LOG_FILE:
+        file_handler = _file_handler()
+        file_handler.setFormatter(JsonFormatter() if settings.LOG_FORMAT == "json" else text_formatter)
+        handlers.append(file_handler)
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(text_formatter)
+    handlers.append(console_handler)
+
+    log_queue: queue.Queue = queue.Queue(-1)
+    queue_handler = _QueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter({"httpx": settings.LOG_HTTPX_SAMPLE_EVERY}))
+    queue_handler.addFilter(TraceFilter())
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(settings.LOG_LEVEL)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+def stop_logging():
+    """
+    Flush queued records and stop the logging thread.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
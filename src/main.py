@@ -1,137 +1,291 @@
-from fastapi import FastAPI, Request, HTTPException, BackgroundTasks
+from fastapi import FastAPI, Request, HTTPException, Response, Depends, Header
+from fastapi.responses import PlainTextResponse
+from pydantic import ValidationError
 from src.config import settings
-from src.models import LandbotMessage, HubSpotWebhookPayload
+from src.logging_config import setup_logging, LazyJson
+from src.models import LandbotInbound, LandbotMessage, InboundMessage, HubSpotWebhookPayload
 from src.services.hubspot_service import hubspot_service
 from src.services.landbot_service import landbot_service
+from src.services.http_client import open_http_clients, close_http_clients
+from src.services.contact_cache import contact_cache
+from src.services.contact_batcher import contact_batcher
+from src.services.contact_warmup import contact_warmup
+from src.services.thread_state import thread_state
+from src.services.ticket_scheduler import ticket_scheduler
+from src.services.outbox import outbox, OutboxFull
+from src.services.rate_limiter import rate_limiter
+from src.services.retry import idempotency
+from src.services.circuit_breaker import circuit_breakers
+from src.services.dedup import recent_messages, landbot_message_key, hubspot_message_key
+from src.services import metrics
+from src.services.tracing import tracer, TraceMiddleware, MemoryExporter
+from src.services.diagnostics import loop_monitor, profiler, ProfileBusy
+from contextlib import asynccontextmanager
+from collections import Counter
+from dataclasses import asdict
+import hmac
 import logging
 import json
 from datetime import datetime
+from typing import Optional
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("debug_webhooks.log"),
-        logging.StreamHandler()
-    ]
-)
+# Configure logging (queued; file and console writes happen on a background thread)
+setup_logging()
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Landbot-HubSpot Middleware")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warn (with the stack) whenever something blocks the event loop
+    loop_monitor.start()
+    # Open long-lived upstream connection pools before accepting traffic
+    await open_http_clients()
+    hubspot_service.start_token_renewal()
+    # Learn up front whether landbot_customer_id exists, so contact lookups never probe it per message
+    hubspot_service.start_property_probe()
+    if settings.CONTACT_WARMUP:
+        contact_warmup.start()
+    ticket_scheduler.start()
+    await outbox.start()
+    yield
+    await outbox.stop()
+    await contact_batcher.stop()
+    await contact_warmup.stop()
+    idempotency.close()
+    await ticket_scheduler.stop()
+    await hubspot_service.stop_property_probe()
+    await hubspot_service.stop_token_renewal()
+    # Release pooled upstream connections on shutdown
+    await close_http_clients()
+    contact_cache.close()
+    tracer.close()
+    await loop_monitor.stop()
+    metrics.mark_process_dead()
+
+app = FastAPI(title="Landbot-HubSpot Middleware", lifespan=lifespan)
+app.add_middleware(metrics.AckLatencyMiddleware)
+app.add_middleware(TraceMiddleware, tracer=tracer)
+
+# Landbot messages dropped before processing, by reason. Counted instead of logged:
+# bot and system traffic is most of what the MessageHook sends.
+ignored_messages: Counter = Counter()
+# Sender types come from the webhook body; anything unexpected is counted as "other".
+# "no_agent_batch" counts whole MessageHook batches dropped undecoded, not messages.
+IGNORE_REASONS = frozenset({"bot", "sys", "agent", "no_agent", "no_agent_batch", "invalid"})
+
+def ignore_message(reason: str):
+    if reason not in IGNORE_REASONS:
+        reason = "other"
+    ignored_messages[reason] += 1
+    metrics.messages_dropped.labels(reason).inc()
+
+# Outbox job kinds
+JOB_LANDBOT_TO_HUBSPOT = "landbot_to_hubspot"
+JOB_HUBSPOT_TO_LANDBOT = "hubspot_to_landbot"
+
+async def enqueue_once(kind: str, payload: dict, key: str, dedup_key: str, dedup_ttl: float) -> bool:
+    """
+    Queue a webhook message unless it was already accepted (redelivery or retry
+    by the sender). Returns False for duplicates.
+    """
+    # Cheap in-process check first; the outbox table is authoritative across workers
+    if dedup_key in recent_messages:
+        outbox.duplicates += 1
+        metrics.messages_dropped.labels("duplicate").inc()
+        return False
+    accepted = await outbox.enqueue(kind, payload, key=key, dedup_key=dedup_key, dedup_ttl=dedup_ttl)
+    if dedup_ttl >= settings.DEDUP_TTL:
+        # Short-window content keys stay out of the long-lived front set
+        recent_messages.add(dedup_key)
+    return accepted
 
 @app.get("/health")
 def health_check():
     return {"status": "ok", "version": "1.0.0"}
 
+@app.get("/stats")
+def stats():
+    return {
+        "contact_cache": contact_cache.stats(),
+        "contact_batcher": contact_batcher.stats(),
+        "contact_warmup": contact_warmup.stats(),
+        "thread_state": thread_state.stats(),
+        "ticket_scheduler": ticket_scheduler.stats(),
+        "outbox": outbox.stats(),
+        "rate_limits": rate_limiter.stats(),
+        "circuit_breakers": {name: breaker.stats() for name, breaker in circuit_breakers.items()},
+        "ignored_messages": dict(ignored_messages),
+        "event_loop": loop_monitor.stats(),
+    }
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """
+    Prometheus scrape endpoint. /stats stays the human-readable view.
+    """
+    # Counted on the event loop, which owns the outbox connection
+    metrics.outbox_depth.set(outbox.recount())
+    data, content_type = metrics.render()
+    return Response(content=data, media_type=content_type)
+
+def require_admin(authorization: Optional[str] = Header(None)):
+    """
+    Admin endpoints need `Authorization: Bearer <ADMIN_TOKEN>`; they do not exist without a token.
+    """
+    if not settings.ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not hmac.compare_digest(authorization or "", f"Bearer {settings.ADMIN_TOKEN}"):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+@app.get("/debug/traces", dependencies=[Depends(require_admin)])
+def debug_traces(limit: int = 20, trace_id: Optional[str] = None):
+    """
+    Recent message traces of this worker and latency percentiles per hop.
+    """
+    memory = tracer.exporter(MemoryExporter)
+    if memory is None:
+        raise HTTPException(status_code=404, detail="Memory trace exporter is disabled (TRACE_EXPORTERS)")
+    return {"summary": memory.summary(), "traces": memory.traces(limit, trace_id)}
+
+@app.post("/admin/profile", dependencies=[Depends(require_admin)], response_class=PlainTextResponse)
+async def admin_profile(seconds: float = 10, mode: str = "sample", interval_ms: float = 5, top: int = 50):
+    """
+    Profile this worker for `seconds`. mode=sample returns collapsed stacks for a
+    flamegraph; mode=cprofile returns pstats text (top functions by cumulative time).
+    """
+    if mode not in ("sample", "cprofile"):
+        raise HTTPException(status_code=400, detail="mode must be 'sample' or 'cprofile'")
+    if not 0 < seconds <= settings.PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be between 0 and {settings.PROFILE_MAX_SECONDS}")
+    try:
+        return await profiler.profile(mode, seconds, interval=max(interval_ms, 1) / 1000, top=top)
+    except ProfileBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
 @app.post("/webhook/landbot-inbound")
-async def landbot_inbound(request: Request, background_tasks: BackgroundTasks):
+async def landbot_inbound(request: Request):
     """
     Handle incoming messages from Landbot (Human Takeover or MessageHook).
     """
     try:
-        payload = await request.json()
-        
-        # Landbot MessageHooks send a list of messages
-        messages = payload.get("messages", [])
+        body = await request.body()
+        # Fast path: a MessageHook batch with no agent_id anywhere is all bot-mode
+        # traffic, so it can be dropped without decoding it
+        if b'"messages"' in body and b'"agent_id"' not in body:
+            ignore_message("no_agent_batch")
+            return {"status": "ignored", "reason": "No agent assigned"}
+
+        inbound = LandbotInbound.from_json(body)
+        messages = inbound.messages
         if not messages:
-            # Fallback for direct Webhook block if used
-            if "customer" in payload and "message" in payload:
-                messages = [payload]
-            else:
-                return {"status": "ignored", "reason": "No messages found"}
-
-        for msg_item in messages:
-            # 1. Identify Sender
-            sender = msg_item.get("sender", {})
-            # Default to 'customer' if not specified (common in direct Webhook blocks)
-            sender_type = sender.get("type") or msg_item.get("author_type") or "customer"
-            
+            return {"status": "ignored", "reason": "No messages found"}
+
+        queued = duplicates = 0
+        for raw_message in messages:
+            if not isinstance(raw_message, dict):
+                ignore_message("invalid")
+                continue
+            sender_type = LandbotInbound.sender_type(raw_message)
             if sender_type != "customer":
-                logger.info(f"Ignoring message from {sender_type}")
+                ignore_message(sender_type)
                 continue
 
-            # 2. Extract Data
-            customer = msg_item.get("customer", {})
-            customer_id = customer.get("id")
-            customer_name = customer.get("name", "Visitor")
-            customer_phone = customer.get("phone")
-            
-            # Check if user is in "Human Takeover" mode in Landbot
-            # If agent_id is present, it means a human is/was assigned
-            agent_id = customer.get("agent_id")
-            
-            # IMPORTANT: We only bridge to HubSpot if an agent is assigned.
-            # EXCEPTION: If the payload came from a direct Webhook block (not MessageHook), 
+            # IMPORTANT: We only bridge to HubSpot if an agent is assigned (Human Takeover).
+            # EXCEPTION: If the payload came from a direct Webhook block (not MessageHook),
             # we assume the user explicitly wants to send this message.
-            is_direct_webhook = "messages" not in payload
-            
-            if not agent_id and not is_direct_webhook:
-                logger.info(f"Ignoring message from customer {customer_id}: No agent assigned (Bot mode)")
+            if not inbound.is_direct_webhook and not LandbotInbound.has_agent(raw_message):
+                ignore_message("no_agent")
                 continue
 
-            # Get message text (format varies between Webhook Block and MessageHook)
-            message_text = msg_item.get("message") # Webhook block / _raw
-            if not message_text and "data" in msg_item:
-                message_text = msg_item["data"].get("body") # MessageHook format
-
+            try:
+                msg_item = LandbotMessage.model_validate(raw_message)
+            except ValidationError as e:
+                # Skip just this message; the rest of the batch is still delivered
+                logger.warning(f"Ignoring malformed Landbot message: {e}")
+                ignore_message("invalid")
+                continue
+            message_text = msg_item.text
             if not message_text:
                 continue
 
-            logger.info(f"Processing message for HubSpot: {customer_name} ({customer_id}): {message_text}")
+            customer = msg_item.customer
+            logger.info("Processing message for HubSpot: %s (%s): %s", customer.name, customer.id, message_text)
 
-            # 3. Process in Background
-            background_tasks.add_task(
-                process_landbot_to_hubspot,
-                customer_id,
-                customer_name,
-                customer_phone,
-                message_text
+            # Queue durably; outbox consumers run process_landbot_to_hubspot
+            dedup_key, dedup_ttl = landbot_message_key(msg_item)
+            message = InboundMessage(customer.id, customer.name, customer.phone, message_text, msg_item.timestamp)
+            queued += 1
+            accepted = await enqueue_once(
+                JOB_LANDBOT_TO_HUBSPOT, asdict(message), f"landbot-inbound:{customer.id}", dedup_key, dedup_ttl
             )
+            if not accepted:
+                duplicates += 1
+                logger.info("Ignoring duplicate Landbot message %s", dedup_key, extra={"sample_every": 10})
 
+        # Bot and system messages were skipped above; only customer messages can be duplicates
+        if queued and duplicates == queued:
+            return {"status": "ignored", "reason": "duplicate"}
         return {"status": "processed"}
+    except ValueError as e:
+        # Not JSON, or not a JSON object; redelivering it would not help
+        logger.error(f"❌ Invalid Landbot payload: {e}")
+        raise HTTPException(status_code=400, detail="Invalid payload")
+    except OutboxFull as e:
+        logger.error(f"❌ Outbox full, rejecting Landbot payload: {e}")
+        raise HTTPException(status_code=503, detail="Queue full")
     except Exception as e:
+        # The message may not be in the outbox; a 5xx makes Landbot redeliver it
         logger.error(f"❌ Error processing Landbot payload: {e}")
-        return {"status": "error", "detail": str(e)}
+        raise HTTPException(status_code=500, detail="Internal Server Error")
 
-async def process_landbot_to_hubspot(customer_id, customer_name, customer_phone, message_text):
+def merge_landbot_messages(waiting: dict, later: dict) -> dict:
+    """
+    Coalesce two queued messages of the same customer into one, in arrival order.
+    The merged message keeps the first timestamp and the latest customer details.
+    """
+    merged = dict(later)
+    merged["message_text"] = f"{waiting['message_text']}\n{later['message_text']}"
+    merged["timestamp"] = waiting.get("timestamp") or later.get("timestamp")
+    return merged
+
+async def process_landbot_to_hubspot(message: InboundMessage):
     """
     Logic to ensure contact exists, publish message, and associate with ticket.
     """
+    customer_id = message.customer_id
+    customer_name = message.customer_name
+    customer_phone = message.customer_phone
+    message_text = message.message_text
     try:
         contact_id = None
         # 1. Ensure Contact Exists
         if customer_id:
             try:
-                contact_id = hubspot_service.get_or_create_contact(customer_name, customer_phone, landbot_id=str(customer_id))
+                contact_id = await contact_batcher.resolve(customer_name, customer_phone, landbot_id=str(customer_id))
             except Exception as e:
                 logger.error(f"Failed to sync contact to HubSpot: {e}")
 
         # 2. Publish Message
-        pub_res = hubspot_service.publish_message_to_channel(
+        pub_res = await hubspot_service.publish_message_to_channel(
             customer_id,
             message_text,
             sender_name=customer_name,
-            phone=customer_phone
+            phone=customer_phone,
+            timestamp=message.timestamp
         )
         
         # 3. Associate Contact with Ticket
         # HubSpot Inboxes usually create a ticket automatically for new conversations.
         # We try to find that ticket and link our contact explicitly.
         thread_id = pub_res.get("conversationsThreadId") # Correct field name in v3 response
-        logger.info(f"Thread ID received: {thread_id}, Contact ID: {contact_id}")
+        logger.info("Thread ID received: %s, Contact ID: %s", thread_id, contact_id)
         
         if thread_id and contact_id:
-            import asyncio
-            logger.info("Waiting for HubSpot to create the ticket...")
-            # Wait a few seconds for HubSpot's automatic ticket creation to trigger
-            await asyncio.sleep(5) 
-            
-            ticket_id = hubspot_service.get_thread_associated_ticket(thread_id)
-            if ticket_id:
-                hubspot_service.associate_contact_with_ticket(contact_id, ticket_id)
-            else:
-                logger.info(f"No auto-ticket found for thread {thread_id} yet. Native association might handle it if phone matched.")
+            # Each thread only needs to be linked once; skip the lookup for the rest of the conversation
+            if not thread_state.needs_association(thread_id, contact_id):
+                return
+
+            # Defer the ticket lookup to the central scheduler, which retries with backoff
+            ticket_scheduler.schedule(thread_id, contact_id)
         else:
             if not thread_id:
                 logger.warning(f"No conversationsThreadId in HubSpot response: {pub_res}")
@@ -140,13 +294,15 @@ async def process_landbot_to_hubspot(customer_id, customer_name, customer_phone,
 
     except Exception as e:
         logger.error(f"Error in process_landbot_to_hubspot: {e}")
+        # Let the outbox retry or dead-letter the message instead of dropping it
+        raise
 
 @app.post("/webhook/hubspot-outbound")
-async def hubspot_outbound(payload: HubSpotWebhookPayload, background_tasks: BackgroundTasks):
+async def hubspot_outbound(payload: HubSpotWebhookPayload):
     """
     Handle outgoing messages from HubSpot Custom Channel.
     """
-    logger.info(f"Received HubSpot payload: {payload.dict()}")
+    logger.debug("Received HubSpot payload: %s", LazyJson(payload.model_dump))
     
     if payload.type == "OUTGOING_CHANNEL_MESSAGE_CREATED" or payload.type == "MESSAGE": 
         # "MESSAGE" type might appear in some contexts, but usually "OUTGOING_CHANNEL_MESSAGE_CREATED" for webhooks.
@@ -163,7 +319,7 @@ async def hubspot_outbound(payload: HubSpotWebhookPayload, background_tasks: Bac
         for thread_id in payload.channelIntegrationThreadIds:
             if thread_id.isdigit():
                 landbot_id_str = thread_id
-                logger.info(f"Found Landbot ID in thread IDs: {landbot_id_str}")
+                logger.info("Found Landbot ID in thread IDs: %s", landbot_id_str)
                 break
     
     # Priority 2: Check Recipients (Fallback/Safety)
@@ -173,7 +329,7 @@ async def hubspot_outbound(payload: HubSpotWebhookPayload, background_tasks: Bac
                 recipient.deliveryIdentifier.type == "CHANNEL_SPECIFIC_OPAQUE_ID" and
                 recipient.deliveryIdentifier.value.isdigit()):
                 landbot_id_str = recipient.deliveryIdentifier.value
-                logger.info(f"Found Landbot ID in recipients: {landbot_id_str}")
+                logger.info("Found Landbot ID in recipients: %s", landbot_id_str)
                 break
 
     if not landbot_id_str:
@@ -190,22 +346,47 @@ async def hubspot_outbound(payload: HubSpotWebhookPayload, background_tasks: Bac
             logger.warning("Empty message text received.")
             return {"status": "ignored", "reason": "Empty text"}
 
-        # Send to Landbot
-        background_tasks.add_task(
-            landbot_service.send_text_message,
-            landbot_id,
-            message_text
+        # Queue durably; outbox consumers send it to Landbot
+        dedup_key, dedup_ttl = hubspot_message_key(
+            payload.message.id, payload.channelIntegrationThreadIds, message_text, payload.message.createdAt
         )
+        accepted = await enqueue_once(JOB_HUBSPOT_TO_LANDBOT, {
+            "landbot_id": landbot_id,
+            "message": message_text
+        }, f"hubspot-outbound:{landbot_id}", dedup_key, dedup_ttl)
+        if not accepted:
+            logger.info("Ignoring duplicate HubSpot message %s", dedup_key, extra={"sample_every": 10})
+            return {"status": "ignored", "reason": "duplicate"}
         
         return {"status": "sent"}
         
     except ValueError:
         logger.error(f"Invalid Landbot ID format: {landbot_id_str}")
         raise HTTPException(status_code=400, detail="Invalid Landbot ID format")
+    except OutboxFull as e:
+        logger.error(f"❌ Outbox full, rejecting HubSpot payload: {e}")
+        raise HTTPException(status_code=503, detail="Queue full")
     except Exception as e:
         logger.error(f"Error processing outbound webhook: {e}")
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
+def prefetch_contact(payload: dict):
+    """
+    Queue the contact lookup of a claimed Landbot job, so jobs still waiting for a
+    consumer share HubSpot batches with the running ones.
+    """
+    if payload.get("customer_id"):
+        contact_batcher.prefetch(payload["customer_name"], payload["customer_phone"], landbot_id=str(payload["customer_id"]))
+
+outbox.register(
+    JOB_LANDBOT_TO_HUBSPOT, process_landbot_to_hubspot, record=InboundMessage,
+    coalesce=merge_landbot_messages,
+    window=settings.LANDBOT_DEBOUNCE_WINDOW,
+    max_wait=settings.LANDBOT_DEBOUNCE_MAX_WAIT,
+    prefetch=prefetch_contact,
+)
+outbox.register(JOB_HUBSPOT_TO_LANDBOT, landbot_service.send_text_message)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -1,15 +1,99 @@
-from pydantic import BaseModel, Field
-from typing import Optional, Dict, Any
+import json
+from dataclasses import dataclass
+from pydantic import AliasChoices, BaseModel, Field
+from typing import Optional, Dict, Any, Union
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# Landbot inbound. The same message shape arrives either batched in a MessageHook
+# ({"messages": [...]}) or alone from a direct Webhook block. Every field is optional
+# so one odd message cannot reject the whole batch; unknown fields are skipped.
 
 class LandbotCustomer(BaseModel):
-    id: int
-    name: str
+    id: Optional[int] = None
+    name: Optional[str] = "Visitor"
     phone: Optional[str] = None
-    
+    # Present when a human agent is/was assigned (Human Takeover)
+    agent_id: Optional[Union[int, str]] = None
+
+class LandbotMessageData(BaseModel):
+    body: Optional[str] = None
+
+class LandbotRawMessage(BaseModel):
+    id: Optional[Union[str, int]] = None
+
 class LandbotMessage(BaseModel):
-    customer: LandbotCustomer
-    message: str
-    timestamp: Optional[int] = None
+    id: Optional[Union[str, int]] = Field(None, validation_alias=AliasChoices("_id", "id"))
+    customer: LandbotCustomer = LandbotCustomer()
+    message: Optional[str] = None
+    timestamp: Optional[Union[int, float]] = None
+    data: Optional[LandbotMessageData] = None
+    raw: Optional[LandbotRawMessage] = Field(None, validation_alias="_raw")
+
+    @property
+    def text(self) -> Optional[str]:
+        # Webhook block / _raw carry "message"; MessageHooks carry data.body
+        return self.message or (self.data and self.data.body) or None
+
+    @property
+    def message_id(self) -> Optional[str]:
+        message_id = self.id or (self.raw and self.raw.id)
+        return str(message_id) if message_id else None
+
+class LandbotInbound:
+    """
+    Decoded body of /webhook/landbot-inbound: a MessageHook batch, or a single
+    message from a direct Webhook block.
+
+    Most MessageHook traffic is bot/system chatter, so messages stay raw dicts
+    until they pass sender_type()/has_agent(); only those are validated into
+    LandbotMessage.
+    """
+    __slots__ = ("messages", "is_direct_webhook")
+
+    def __init__(self, messages: list, is_direct_webhook: bool):
+        self.messages = messages
+        self.is_direct_webhook = is_direct_webhook
+
+    @classmethod
+    def from_json(cls, body: bytes) -> "LandbotInbound":
+        payload = _json_loads(body)
+        if not isinstance(payload, dict):
+            raise ValueError("Landbot payload must be a JSON object")
+        messages = payload.get("messages")
+        if messages is not None:
+            return cls(messages if isinstance(messages, list) else [], False)
+        # Fallback for direct Webhook block if used
+        if "customer" in payload and "message" in payload:
+            return cls([payload], True)
+        return cls([], True)
+
+    @staticmethod
+    def sender_type(raw: dict) -> str:
+        sender = raw.get("sender")
+        # Default to 'customer' if not specified (common in direct Webhook blocks)
+        return (isinstance(sender, dict) and sender.get("type")) or raw.get("author_type") or "customer"
+
+    @staticmethod
+    def has_agent(raw: dict) -> bool:
+        customer = raw.get("customer")
+        return isinstance(customer, dict) and bool(customer.get("agent_id"))
+
+@dataclass(slots=True)
+class InboundMessage:
+    """
+    Customer message queued for HubSpot; what the outbox worker receives.
+    """
+    customer_id: int
+    customer_name: str
+    customer_phone: Optional[str]
+    message_text: str
+    # When the customer sent it (epoch seconds, from Landbot); the first one for a merged burst
+    timestamp: Optional[float] = None
 
 class DeliveryIdentifier(BaseModel):
     type: str
@@ -21,8 +105,10 @@ class HubSpotParticipant(BaseModel):
     actorId: Optional[str] = None
 
 class HubSpotMessageContent(BaseModel):
+    id: Optional[str] = None
     text: Optional[str] = None
     richText: Optional[str] = None
+    createdAt: Optional[str] = None
 
 class HubSpotWebhookPayload(BaseModel):
     type: str
@@ -0,0 +1,89 @@
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+from dataclasses import asdict
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
+
+from src.models import LandbotInbound, LandbotMessage, InboundMessage
+
+# A MessageHook batch as Landbot sends it during a Human Takeover: bot and system
+# messages around one customer message, each with the full customer object.
+CUSTOMER = {"id": 123456, "name": "Ana", "phone": "+34600000000", "agent_id": 42, "email": "ana@example.com",
+            "channel_id": 7, "token": "x" * 40, "register_date": 1700000000}
+BATCH = json.dumps({"messages": [
+    {"_id": f"m{i}", "type": "text", "timestamp": 1700000000.5 + i,
+     "sender": {"id": 1, "type": "customer" if i == 2 else ("bot" if i % 2 else "sys")},
+     "customer": CUSTOMER, "data": {"body": f"message {i}"}, "_raw": {"id": f"m{i}", "extra": {"x": [1, 2, 3]}}}
+    for i in range(5)
+]}).encode()
+
+def parse_dicts(body: bytes) -> list:
+    """
+    Previous handler: decode everything into dicts and walk them with .get() chains.
+    """
+    payload = json.loads(body)
+    records = []
+    for msg_item in payload.get("messages", []):
+        sender = msg_item.get("sender", {})
+        sender_type = sender.get("type") or msg_item.get("author_type") or "customer"
+        if sender_type != "customer":
+            continue
+        customer = msg_item.get("customer", {})
+        if not customer.get("agent_id"):
+            continue
+        message_text = msg_item.get("message")
+        if not message_text and "data" in msg_item:
+            message_text = msg_item["data"].get("body")
+        if message_text:
+            records.append({
+                "customer_id": customer.get("id"),
+                "customer_name": customer.get("name", "Visitor"),
+                "customer_phone": customer.get("phone"),
+                "message_text": message_text,
+                "timestamp": msg_item.get("timestamp"),
+            })
+    return records
+
+def parse_models(body: bytes) -> list:
+    """
+    Current handler: screen raw messages, validate only customer ones into the typed schema.
+    """
+    inbound = LandbotInbound.from_json(body)
+    records = []
+    for raw_message in inbound.messages:
+        if LandbotInbound.sender_type(raw_message) != "customer" or not LandbotInbound.has_agent(raw_message):
+            continue
+        msg_item = LandbotMessage.model_validate(raw_message)
+        if not msg_item.text:
+            continue
+        customer = msg_item.customer
+        records.append(InboundMessage(customer.id, customer.name, customer.phone, msg_item.text, msg_item.timestamp))
+    return records
+
+def memory_per_item(build, count: int = 10000) -> float:
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    items = [build(i) for i in range(count)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    del items
+    return size / count
+
+def main():
+    assert [asdict(record) for record in parse_models(BATCH)] == parse_dicts(BATCH)
+    runs = 20000
+    print(f"Parse one {len(BATCH)}-byte MessageHook batch ({runs} runs):")
+    for name, parse in (("dict walk", parse_dicts), ("typed models", parse_models)):
+        seconds = min(timeit.repeat(lambda: parse(BATCH), number=runs, repeat=5))
+        print(f"  {name:<14} {seconds / runs * 1e6:8.1f} µs")
+
+    print("Memory per queued message record:")
+    print(f"  {'dict':<14} {memory_per_item(lambda i: {'customer_id': i, 'customer_name': 'Ana', 'customer_phone': '+34600000000', 'message_text': 'hello', 'timestamp': 1700000000.5}):8.0f} B")
+    print(f"  {'InboundMessage':<14} {memory_per_item(lambda i: InboundMessage(i, 'Ana', '+34600000000', 'hello', 1700000000.5)):8.0f} B")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+"""
+End-to-end benchmark of the middleware against local HubSpot and Landbot stand-ins.
+
+Starts the fake upstreams in this process, runs the app under uvicorn in a
+subprocess pointed at them, drives both webhooks at a fixed rate and reports
+throughput, ack and delivery latency percentiles and upstream calls per message.
+Results are written as JSON; pass --compare with an earlier result to see the change.
+
+    python src/scripts/bench_pipeline.py --rps 50 --duration 20
+    python src/scripts/bench_pipeline.py --hubspot-latency 0.2 --error-rate 0.05 --compare bench_results/baseline.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+import httpx
+import uvicorn
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
+sys.path.append(ROOT)
+
+from src.scripts.fake_upstreams import FakeUpstream, UpstreamBehavior, hubspot_app, landbot_app
+
+INBOUND = "landbot_to_hubspot"
+OUTBOUND = "hubspot_to_landbot"
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def percentiles(values: List[float]) -> dict:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    pick = lambda fraction: round(values[min(len(values) - 1, int(len(values) * fraction))] * 1000, 2)
+    return {"count": len(values), "p50_ms": pick(0.50), "p95_ms": pick(0.95), "p99_ms": pick(0.99), "max_ms": pick(1.0)}
+
+async def serve(app, port: int) -> tuple:
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    return server, task
+
+def start_middleware(port: int, hubspot_url: str, landbot_url: str, workdir: str, workers: int, overrides: dict) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update({
+        "HUBSPOT_API_URL": hubspot_url,
+        "LANDBOT_API_URL": landbot_url,
+        "HUBSPOT_HTTP2": "false",
+        "HUBSPOT_REFRESH_TOKEN": "bench",
+        "HUBSPOT_CHANNEL_ID": "bench-channel",
+        "HUBSPOT_CHANNEL_ACCOUNT_ID": "bench-account",
+        "LANDBOT_API_TOKEN": "bench",
+        "HUBSPOT_TOKEN_STORE_PATH": os.path.join(workdir, "token.json"),
+        "OUTBOX_DB": os.path.join(workdir, "outbox.db"),
+        "IDEMPOTENCY_DB": os.path.join(workdir, "idempotency.db"),
+        "CONTACT_CACHE_DB": "",
+        "LOG_FILE": "",
+        "LOG_LEVEL": env.get("LOG_LEVEL", "WARNING"),
+        # Ticket lookups are part of the message flow; don't wait the production 5s for them
+        "TICKET_LOOKUP_INITIAL_DELAY": env.get("TICKET_LOOKUP_INITIAL_DELAY", "0.5"),
+    })
+    env.update(overrides)
+    command = [sys.executable, "-m", "uvicorn", "src.main:app", "--host", "127.0.0.1", "--port", str(port),
+               "--workers", str(workers), "--log-level", "warning", "--no-access-log"]
+    return subprocess.Popen(command, cwd=ROOT, env=env)
+
+async def wait_healthy(client: httpx.AsyncClient, url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get(f"{url}/health")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.1)
+    raise RuntimeError("Middleware did not become healthy")
+
+def inbound_request(number: int, customers: int, run_id: str) -> tuple:
+    customer = number % customers
+    return "/webhook/landbot-inbound", {
+        "_id": f"{run_id}-{number}",
+        "customer": {"id": 100000 + customer, "name": f"Bench {customer}", "phone": f"+3460{customer:07d}", "agent_id": 1},
+        "message": f"hello bench:{number}",
+        "timestamp": time.time(),
+    }
+
+def outbound_request(number: int, customers: int, run_id: str) -> tuple:
+    customer = number % customers
+    return "/webhook/hubspot-outbound", {
+        "type": "OUTGOING_CHANNEL_MESSAGE_CREATED",
+        "channelId": "bench-channel",
+        "channelIntegrationThreadIds": [str(100000 + customer)],
+        "message": {"id": f"{run_id}-{number}", "text": f"reply bench:{number}"},
+    }
+
+async def drive(client: httpx.AsyncClient, url: str, args, run_id: str) -> Dict[int, dict]:
+    """
+    Send args.rps requests per second for args.duration seconds (open loop: the
+    schedule does not slow down when the middleware does). Returns per message
+    its direction, send time, ack latency and status.
+    """
+    directions = {"inbound": [INBOUND], "outbound": [OUTBOUND], "both": [INBOUND, OUTBOUND]}[args.direction]
+    sent: Dict[int, dict] = {}
+
+    async def send(number: int, direction: str):
+        build = inbound_request if direction == INBOUND else outbound_request
+        path, body = build(number, args.customers, run_id)
+        record = sent[number] = {"direction": direction, "sent_at": time.time(), "ack": None, "status": None}
+        start = time.perf_counter()
+        try:
+            response = await client.post(f"{url}{path}", json=body)
+            record["status"] = response.status_code
+        except httpx.HTTPError as e:
+            record["status"] = type(e).__name__
+        record["ack"] = time.perf_counter() - start
+
+    total = int(args.rps * args.duration)
+    tasks = []
+    start = time.monotonic()
+    for number in range(total):
+        delay = start + number / args.rps - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(send(number, directions[number % len(directions)])))
+    await asyncio.gather(*tasks)
+    return sent
+
+async def wait_delivered(sent: Dict[int, dict], deliveries: Dict[str, dict], timeout: float):
+    expected = {number for number, record in sent.items() if record["status"] == 200}
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        delivered = set(deliveries[INBOUND]) | set(deliveries[OUTBOUND])
+        if expected <= delivered:
+            return
+        await asyncio.sleep(0.1)
+
+def report(args, sent: Dict[int, dict], hubspot: FakeUpstream, landbot: FakeUpstream, elapsed: float) -> dict:
+    deliveries = {INBOUND: hubspot.deliveries, OUTBOUND: landbot.deliveries}
+    directions = {}
+    for direction in (INBOUND, OUTBOUND):
+        records = {number: record for number, record in sent.items() if record["direction"] == direction}
+        if not records:
+            continue
+        delivered = [deliveries[direction][number] - record["sent_at"] for number, record in records.items() if number in deliveries[direction]]
+        last_delivery = max((deliveries[direction][number] for number in records if number in deliveries[direction]), default=None)
+        first_sent = min(record["sent_at"] for record in records.values())
+        statuses: Dict[str, int] = {}
+        for record in records.values():
+            statuses[str(record["status"])] = statuses.get(str(record["status"]), 0) + 1
+        directions[direction] = {
+            "sent": len(records),
+            "acked": statuses.get("200", 0),
+            "delivered": len(delivered),
+            "statuses": statuses,
+            "ack_latency": percentiles([record["ack"] for record in records.values() if record["ack"] is not None]),
+            "delivery_latency": percentiles(delivered),
+            "delivered_per_second": round(len(delivered) / (last_delivery - first_sent), 2) if last_delivery else 0.0,
+        }
+
+    messages = len(sent)
+    return {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "git_commit": subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip(),
+        "elapsed_seconds": round(elapsed, 2),
+        "directions": directions,
+        "upstream_calls": {"hubspot": dict(hubspot.calls), "landbot": dict(landbot.calls)},
+        "upstream_calls_per_message": {
+            f"{name}.{operation}": round(count / messages, 3)
+            for name, upstream in (("hubspot", hubspot), ("landbot", landbot))
+            for operation, count in sorted(upstream.calls.items())
+        } if messages else {},
+        "upstream_rejections": {"hubspot": dict(hubspot.rejected), "landbot": dict(landbot.rejected)},
+    }
+
+def print_report(result: dict, baseline: Optional[dict] = None):
+    def change(path: list) -> str:
+        if baseline is None:
+            return ""
+        before, now = baseline, result
+        for key in path:
+            before = before.get(key, {}) if isinstance(before, dict) else {}
+            now = now.get(key, {}) if isinstance(now, dict) else {}
+        if not isinstance(before, (int, float)) or not before:
+            return ""
+        return f" ({(now - before) / before * 100:+.1f}%)"
+
+    for direction, stats in result["directions"].items():
+        print(f"{direction}: sent {stats['sent']}, acked {stats['acked']}, delivered {stats['delivered']}, "
+              f"{stats['delivered_per_second']}/s{change(['directions', direction, 'delivered_per_second'])}")
+        for metric in ("ack_latency", "delivery_latency"):
+            values = stats[metric]
+            if not values.get("count"):
+                continue
+            line = ", ".join(f"{key} {values[key]}{change(['directions', direction, metric, key])}" for key in ("p50_ms", "p95_ms", "p99_ms"))
+            print(f"  {metric:<17} {line}")
+    print("upstream calls per message:")
+    for operation, count in result["upstream_calls_per_message"].items():
+        print(f"  {operation:<24} {count}{change(['upstream_calls_per_message', operation])}")
+
+async def run(args) -> dict:
+    run_id = f"bench-{int(time.time())}"
+    hubspot = FakeUpstream("hubspot", UpstreamBehavior(args.hubspot_latency, args.jitter, args.error_rate, args.hubspot_rate_limit), args.seed)
+    landbot = FakeUpstream("landbot", UpstreamBehavior(args.landbot_latency, args.jitter, args.error_rate, args.landbot_rate_limit), args.seed)
+    hubspot_port, landbot_port, app_port = free_port(), free_port(), free_port()
+    servers = [await serve(hubspot_app(hubspot), hubspot_port), await serve(landbot_app(landbot), landbot_port)]
+
+    with tempfile.TemporaryDirectory() as workdir:
+        overrides = dict(setting.split("=", 1) for setting in args.set)
+        process = start_middleware(
+            app_port, f"http://127.0.0.1:{hubspot_port}", f"http://127.0.0.1:{landbot_port}", workdir, args.workers, overrides
+        )
+        url = f"http://127.0.0.1:{app_port}"
+        limits = httpx.Limits(max_connections=args.connections, max_keepalive_connections=args.connections)
+        try:
+            async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+                await wait_healthy(client, url)
+                start = time.monotonic()
+                sent = await drive(client, url, args, run_id)
+                await wait_delivered(sent, {INBOUND: hubspot.deliveries, OUTBOUND: landbot.deliveries}, args.drain)
+                elapsed = time.monotonic() - start
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+            for server, _ in servers:
+                server.should_exit = True
+            await asyncio.gather(*(task for _, task in servers))
+    return report(args, sent, hubspot, landbot, elapsed)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rps", type=float, default=50, help="webhook requests per second")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of load")
+    parser.add_argument("--direction", choices=["inbound", "outbound", "both"], default="both")
+    parser.add_argument("--customers", type=int, default=100, help="distinct conversations")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    parser.add_argument("--connections", type=int, default=200, help="concurrent client connections")
+    parser.add_argument("--hubspot-latency", type=float, default=0.05)
+    parser.add_argument("--landbot-latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.5, help="latency spread, as a share of the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of upstream calls answered with 503")
+    parser.add_argument("--hubspot-rate-limit", type=int, default=0, help="requests/s before 429; 0 = unlimited")
+    parser.add_argument("--landbot-rate-limit", type=int, default=0, help="requests/s before 429; 0 = unlimited")
+    parser.add_argument("--drain", type=float, default=60, help="seconds to wait for deliveries after the load")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="middleware setting, e.g. --set LANDBOT_RATE_LIMIT_MAX=100 (repeatable)")
+    parser.add_argument("--output", help="result file (default bench_results/<timestamp>.json)")
+    parser.add_argument("--compare", help="earlier result file to compare against")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+    print_report(result, baseline)
+
+    output = args.output or os.path.join(ROOT, "bench_results", f"{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(result, file, indent=2)
+    print(f"Results written to {output}")
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import asyncio
 import requests
 import os
 import sys
@@ -9,7 +10,7 @@ from src.services.hubspot_service import hubspot_service
 
 def check_property():
     load_dotenv()
-    token = hubspot_service.get_token()
+    token = asyncio.run(hubspot_service.get_token())
     url = "https://api.hubapi.com/crm/v3/properties/contacts/landbot_customer_id"
     headers = {"Authorization": f"Bearer {token}"}
     
@@ -0,0 +1,146 @@
+"""
+Local stand-ins for the HubSpot and Landbot APIs, used by bench_pipeline.py.
+
+They answer the endpoints the middleware calls with the shapes it expects, with
+configurable latency, error rate and rate limit, and record every call and the
+time each benchmark message (tagged "bench:<n>" in its text) was delivered.
+"""
+import asyncio
+import itertools
+import random
+import re
+import time
+from collections import Counter
+from dataclasses import dataclass
+from typing import Dict, Optional
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+BENCH_TAG = re.compile(r"bench:(\d+)")
+
+@dataclass
+class UpstreamBehavior:
+    latency: float = 0.05  # seconds per response, before jitter
+    jitter: float = 0.5  # +/- share of latency
+    error_rate: float = 0.0  # share of requests answered with 503
+    rate_limit: int = 0  # requests per second before answering 429; 0 = unlimited
+
+class FakeUpstream:
+    def __init__(self, name: str, behavior: UpstreamBehavior, seed: Optional[int] = None):
+        self.name = name
+        self.behavior = behavior
+        self.random = random.Random(seed)
+        self.calls: Counter = Counter()
+        self.rejected: Counter = Counter()
+        # Benchmark message number -> time.time() it arrived
+        self.deliveries: Dict[int, float] = {}
+        self._window = 0
+        self._window_count = 0
+
+    async def gate(self, operation: str) -> Optional[JSONResponse]:
+        """
+        Count the call, wait the simulated latency and return an error response
+        if this call is rate limited or picked to fail.
+        """
+        self.calls[operation] += 1
+        behavior = self.behavior
+        if behavior.rate_limit:
+            window = int(time.monotonic())
+            if window != self._window:
+                self._window, self._window_count = window, 0
+            self._window_count += 1
+            if self._window_count > behavior.rate_limit:
+                self.rejected["429"] += 1
+                return JSONResponse({"status": "error", "category": "RATE_LIMITS"}, status_code=429, headers={"Retry-After": "1"})
+        if behavior.latency:
+            spread = behavior.latency * behavior.jitter
+            await asyncio.sleep(max(0.0, behavior.latency + self.random.uniform(-spread, spread)))
+        if behavior.error_rate and self.random.random() < behavior.error_rate:
+            self.rejected["503"] += 1
+            return JSONResponse({"status": "error"}, status_code=503)
+        return None
+
+    def delivered(self, text: Optional[str]):
+        now = time.time()
+        for number in BENCH_TAG.findall(text or ""):
+            self.deliveries.setdefault(int(number), now)
+
+def hubspot_app(upstream: FakeUpstream) -> FastAPI:
+    app = FastAPI()
+    contacts: Dict[str, dict] = {}
+    ids = itertools.count(1)
+
+    def create(properties: dict) -> dict:
+        contact = {"id": str(next(ids)), "properties": dict(properties)}
+        contacts[contact["id"]] = contact
+        return contact
+
+    @app.post("/oauth/v1/token")
+    async def token():
+        return await upstream.gate("token_refresh") or {"access_token": "bench-token", "expires_in": 1800}
+
+    @app.get("/crm/v3/properties/contacts/{name}")
+    async def property_info(name: str):
+        return await upstream.gate("property_probe") or {"name": name}
+
+    @app.post("/crm/v3/objects/contacts/search")
+    async def search(request: Request):
+        error = await upstream.gate("contact_search")
+        if error:
+            return error
+        body = await request.json()
+        condition = body["filterGroups"][0]["filters"][0]
+        name, operator = condition["propertyName"], condition["operator"]
+        if operator == "HAS_PROPERTY":
+            results = [contact for contact in contacts.values() if contact["properties"].get(name)]
+        else:
+            values = set(condition.get("values") or [condition.get("value")])
+            results = [contact for contact in contacts.values() if contact["properties"].get(name) in values]
+        return {"total": len(results), "results": results[:body.get("limit", 10)]}
+
+    @app.post("/crm/v3/objects/contacts")
+    async def create_contact(request: Request):
+        error = await upstream.gate("contact_create")
+        if error:
+            return error
+        return JSONResponse(create((await request.json())["properties"]), status_code=201)
+
+    @app.post("/crm/v3/objects/contacts/batch/create")
+    async def create_contacts(request: Request):
+        error = await upstream.gate("contact_create")
+        if error:
+            return error
+        inputs = (await request.json())["inputs"]
+        return JSONResponse({"status": "COMPLETE", "results": [create(item["properties"]) for item in inputs]}, status_code=201)
+
+    @app.post("/conversations/v3/custom-channels/{channel_id}/messages")
+    async def publish(channel_id: str, request: Request):
+        error = await upstream.gate("publish")
+        if error:
+            return error
+        body = await request.json()
+        upstream.delivered(body.get("text"))
+        return {"id": f"msg-{next(ids)}", "conversationsThreadId": f"thread-{body.get('integrationThreadId')}"}
+
+    @app.get("/conversations/v3/conversations/threads/{thread_id}")
+    async def thread(thread_id: str):
+        return await upstream.gate("thread_lookup") or {"id": thread_id, "threadAssociations": {"associatedTicketId": f"ticket-{thread_id}"}}
+
+    @app.put("/crm/v3/objects/contacts/{contact_id}/associations/tickets/{ticket_id}/{association_type}")
+    async def associate(contact_id: str, ticket_id: str, association_type: str):
+        return await upstream.gate("association") or {"id": contact_id}
+
+    return app
+
+def landbot_app(upstream: FakeUpstream) -> FastAPI:
+    app = FastAPI()
+
+    @app.post("/v1/customers/{customer_id}/send_text/")
+    async def send_text(customer_id: int, request: Request):
+        error = await upstream.gate("send_text")
+        if error:
+            return error
+        upstream.delivered((await request.json()).get("message"))
+        return JSONResponse({"success": True}, status_code=201)
+
+    return app
@@ -1,3 +1,4 @@
+import asyncio
 import requests
 import os
 import sys
@@ -12,7 +13,7 @@ from src.services.hubspot_service import hubspot_service
 def create_landbot_id_property():
     print(f"Creating property '{settings.PROP_LANDBOT_ID}' in HubSpot...")
     
-    token = hubspot_service.get_token()
+    token = asyncio.run(hubspot_service.get_token())
     url = "https://api.hubapi.com/crm/v3/properties/contacts"
     
     headers = {
@@ -1,3 +1,4 @@
+import asyncio
 import os
 import sys
 from dotenv import load_dotenv
@@ -11,7 +12,7 @@ from src.services.hubspot_service import hubspot_service
 def test_hubspot_contact(name, phone, landbot_id):
     print(f"Testing contact creation/search in HubSpot for {name} ({landbot_id})...")
     try:
-        contact_id = hubspot_service.get_or_create_contact(name, phone, landbot_id=str(landbot_id))
+        contact_id = asyncio.run(hubspot_service.get_or_create_contact(name, phone, landbot_id=str(landbot_id)))
         print(f"✅ Contact ID: {contact_id}")
     except Exception as e:
         print(f"❌ Error: {e}")
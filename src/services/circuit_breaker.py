@@ -0,0 +1,104 @@
+import logging
+import time
+from typing import Awaitable, Callable, Dict
+import httpx
+from src.config import settings
+from src.services.http_client import HUBSPOT, LANDBOT
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+class CircuitOpenError(Exception):
+    def __init__(self, name: str, retry_at: float):
+        super().__init__(f"Circuit for {name} is open")
+        self.name = name
+        # Wall-clock time at which the breaker will let a probe through
+        self.retry_at = retry_at
+
+class CircuitBreaker:
+    """
+    Stops calling an upstream after repeated failures.
+
+    closed: calls flow; consecutive failures are counted.
+    open: calls fail fast with CircuitOpenError until recovery_timeout passes.
+    half_open: a limited number of probe calls go through; a success closes the
+    breaker, a failure opens it again.
+    """
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_timeout: float = 30, half_open_max_calls: int = 1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probes = 0
+        self.rejected = 0
+
+    def _transition(self, state: str):
+        if state != self.state:
+            logger.warning(f"Circuit for {self.name}: {self.state} -> {state}")
+            self.state = state
+
+    def before_call(self):
+        if self.state == OPEN:
+            if time.time() - self.opened_at < self.recovery_timeout:
+                self.rejected += 1
+                raise CircuitOpenError(self.name, self.opened_at + self.recovery_timeout)
+            self._transition(HALF_OPEN)
+            self._probes = 0
+        if self.state == HALF_OPEN:
+            if self._probes >= self.half_open_max_calls:
+                self.rejected += 1
+                raise CircuitOpenError(self.name, time.time() + 1)
+            self._probes += 1
+
+    def record_success(self):
+        self.failures = 0
+        self._transition(CLOSED)
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opened_at = time.time()
+            self._transition(OPEN)
+
+    async def call(self, send: Callable[[], Awaitable[httpx.Response]]) -> httpx.Response:
+        """
+        Run send() through the breaker. Transport errors and 5xx responses count as failures.
+        """
+        self.before_call()
+        try:
+            response = await send()
+        except httpx.TransportError:
+            self.record_failure()
+            raise
+        except Exception:
+            # Not the upstream's fault (e.g. no rate budget); give the probe slot back
+            if self.state == HALF_OPEN:
+                self._probes = max(self._probes - 1, 0)
+            raise
+        if response.status_code >= 500:
+            self.record_failure()
+        else:
+            self.record_success()
+        return response
+
+    def stats(self) -> dict:
+        stats = {"state": self.state, "consecutive_failures": self.failures, "rejected": self.rejected}
+        if self.state == OPEN:
+            stats["retry_in"] = round(max(self.opened_at + self.recovery_timeout - time.time(), 0.0), 1)
+        return stats
+
+circuit_breakers: Dict[str, CircuitBreaker] = {
+    upstream: CircuitBreaker(
+        upstream,
+        failure_threshold=settings.CIRCUIT_FAILURE_THRESHOLD,
+        recovery_timeout=settings.CIRCUIT_RECOVERY_TIMEOUT,
+        half_open_max_calls=settings.CIRCUIT_HALF_OPEN_MAX_CALLS,
+    )
+    for upstream in (HUBSPOT, LANDBOT)
+}
@@ -0,0 +1,230 @@
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+import httpx
+from src.config import settings
+from src.services.contact_cache import contact_cache
+from src.services.hubspot_service import hubspot_service
+from src.services.phone import to_e164, phone_variants
+
+logger = logging.getLogger(__name__)
+
+# HubSpot batch endpoints and IN filters take at most 100 items
+MAX_BATCH_SIZE = 100
+
+@dataclass
+class PendingContact:
+    name: str
+    phone: Optional[str]
+    landbot_id: Optional[str]
+    future: asyncio.Future = field(repr=False)
+
+class ContactBatcher:
+    """
+    Resolves Landbot customers to HubSpot contacts in batches.
+
+    Cache misses are looked up together: one IN search by Landbot ID, one by phone
+    for the rest, and one batch create for whoever is still unknown. Each caller
+    awaits its own result; concurrent callers for the same customer share one entry.
+
+    When no batch is running, a miss waits at most `window` (0: the current event
+    loop iteration) for others to join. While a batch is running, new misses
+    collect until it finishes, so batches grow with load. Outbox jobs prefetch
+    their customer when claimed, so jobs waiting for a consumer join batches too.
+    If a batch step fails, the affected customers fall back to the single-contact path.
+    """
+    def __init__(self, window: float = 0, batch_size: int = MAX_BATCH_SIZE):
+        self.window = window
+        self.batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self._pending: Dict[str, PendingContact] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: set = set()
+        self.prefetched = 0
+        self.batches = 0
+        self.resolved = 0
+        self.fallbacks = 0
+
+    @staticmethod
+    def _key(landbot_id: Optional[str], phone: Optional[str]) -> Optional[str]:
+        if landbot_id:
+            return contact_cache.landbot_key(landbot_id)
+        return contact_cache.phone_key(phone)
+
+    def _add(self, name: str, phone: Optional[str], landbot_id: Optional[str]) -> Optional[PendingContact]:
+        """
+        The pending entry for the customer, queued for the next batch. None when
+        batching is off or the customer has no key.
+        """
+        key = self._key(landbot_id, phone)
+        if self.batch_size <= 1 or key is None:
+            return None
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = PendingContact(name, phone, landbot_id, asyncio.get_running_loop().create_future())
+            self._pending[key] = pending
+            if len(self._pending) >= self.batch_size:
+                self._flush_pending()
+            elif not self._tasks and self._timer is None:
+                self._timer = asyncio.get_running_loop().call_later(self.window, self._flush_pending)
+        return pending
+
+    async def resolve(self, name: str, phone: Optional[str], landbot_id: Optional[str] = None) -> str:
+        """
+        Contact ID for the customer, creating the contact if needed.
+        """
+        cached_id = contact_cache.get(landbot_id=landbot_id, phone=phone)
+        if cached_id:
+            return cached_id
+
+        pending = self._add(name, phone, landbot_id)
+        if pending is None:
+            return await hubspot_service.get_or_create_contact(name, phone, landbot_id=landbot_id, check_cache=False)
+        # Shielded so one cancelled caller does not cancel the result for others sharing it
+        return await asyncio.shield(pending.future)
+
+    def prefetch(self, name: str, phone: Optional[str], landbot_id: Optional[str] = None):
+        """
+        Start resolving a customer whose job is about to run, without waiting.
+        resolve() later finds the result in the cache or joins the pending entry.
+        """
+        if contact_cache.contains(landbot_id=landbot_id, phone=phone):
+            return
+        pending = self._add(name, phone, landbot_id)
+        if pending is not None:
+            self.prefetched += 1
+            # A failure is reported to resolve() callers; nobody may be waiting on this one
+            pending.future.add_done_callback(lambda future: future.cancelled() or future.exception())
+
+    def _flush_pending(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = list(self._pending.values()), {}
+        if batch:
+            task = asyncio.create_task(self._resolve_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._batch_finished)
+
+    def _batch_finished(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        # Misses that arrived while the batch ran go out together
+        if self._pending and not self._tasks:
+            self._flush_pending()
+
+    async def _search(self, property_name: str, values: list) -> Dict[str, str]:
+        try:
+            return await hubspot_service.search_contacts(property_name, values)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 400 and property_name == settings.PROP_LANDBOT_ID:
+                hubspot_service.mark_landbot_property_missing()
+            else:
+                logger.warning(f"Batch search by {property_name} failed: {e}")
+        except Exception as e:
+            logger.warning(f"Batch search by {property_name} failed: {e}")
+        return {}
+
+    @staticmethod
+    def _match_value(pending: PendingContact, match_property: str) -> Optional[str]:
+        return pending.landbot_id if match_property == settings.PROP_LANDBOT_ID else to_e164(pending.phone)
+
+    @staticmethod
+    def _properties(pending: PendingContact, match_property: str) -> dict:
+        properties = {"firstname": pending.name, "phone": to_e164(pending.phone) or pending.phone}
+        if match_property == settings.PROP_LANDBOT_ID:
+            properties[settings.PROP_LANDBOT_ID] = pending.landbot_id
+        return properties
+
+    async def _resolve_batch(self, batch: list):
+        try:
+            await self._lookup_batch(batch)
+        except Exception as e:
+            logger.error(f"❌ Contact batch of {len(batch)} failed: {e}")
+            for pending in batch:
+                if not pending.future.done():
+                    pending.future.set_exception(e)
+        finally:
+            # Cancelled on shutdown: never leave a caller waiting on its entry
+            for pending in batch:
+                if not pending.future.done():
+                    pending.future.set_exception(RuntimeError("Contact batch was cancelled"))
+
+    async def _lookup_batch(self, batch: list):
+        self.batches += 1
+        unresolved = list(batch)
+        found: Dict[int, str] = {}
+
+        # 1. Search by Landbot ID, then by phone for whoever is left
+        use_landbot_id = hubspot_service.landbot_property_available
+        landbot_ids = list({pending.landbot_id for pending in unresolved if pending.landbot_id}) if use_landbot_id else []
+        if landbot_ids:
+            by_landbot_id = await self._search(settings.PROP_LANDBOT_ID, landbot_ids)
+            for pending in unresolved:
+                if pending.landbot_id in by_landbot_id:
+                    found[id(pending)] = by_landbot_id[pending.landbot_id]
+            unresolved = [pending for pending in unresolved if id(pending) not in found]
+
+        # Every stored form of each phone; an IN filter takes at most 100 values
+        phones = list(dict.fromkeys(variant for pending in unresolved for variant in phone_variants(pending.phone)))
+        by_phone: Dict[str, str] = {}
+        for start in range(0, len(phones), MAX_BATCH_SIZE):
+            by_phone.update(await self._search("phone", phones[start:start + MAX_BATCH_SIZE]))
+        if by_phone:
+            for pending in unresolved:
+                contact_id = next((by_phone[variant] for variant in phone_variants(pending.phone) if variant in by_phone), None)
+                if contact_id:
+                    found[id(pending)] = contact_id
+            unresolved = [pending for pending in unresolved if id(pending) not in found]
+
+        # 2. Create the rest in one call; created contacts are matched back by Landbot ID
+        # (or by phone while the property is missing)
+        match_property = settings.PROP_LANDBOT_ID if hubspot_service.landbot_property_available else "phone"
+        creatable = [pending for pending in unresolved if self._match_value(pending, match_property)]
+        if creatable:
+            try:
+                created = await hubspot_service.create_contacts([self._properties(pending, match_property) for pending in creatable])
+                by_value = {result["properties"].get(match_property): result["id"] for result in created}
+                for pending in creatable:
+                    if self._match_value(pending, match_property) in by_value:
+                        found[id(pending)] = by_value[self._match_value(pending, match_property)]
+            except Exception as e:
+                logger.warning(f"Batch create of {len(creatable)} contacts failed: {e}")
+
+        for pending in batch:
+            contact_id = found.get(id(pending))
+            if contact_id:
+                contact_cache.set(contact_id, landbot_id=pending.landbot_id, phone=pending.phone)
+                self.resolved += 1
+                pending.future.set_result(contact_id)
+
+        # 3. Anything the batch calls could not settle goes through the single-contact path
+        leftovers = [pending for pending in batch if not pending.future.done()]
+        if leftovers:
+            self.fallbacks += len(leftovers)
+            results = await asyncio.gather(
+                *(hubspot_service.get_or_create_contact(pending.name, pending.phone, landbot_id=pending.landbot_id, check_cache=False)
+                  for pending in leftovers),
+                return_exceptions=True
+            )
+            for pending, result in zip(leftovers, results):
+                if isinstance(result, BaseException):
+                    pending.future.set_exception(result)
+                else:
+                    pending.future.set_result(result)
+
+    async def stop(self):
+        # Finishing a batch may send out the misses that collected meanwhile
+        while self._pending or self._tasks:
+            self._flush_pending()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "batches": self.batches,
+            "resolved": self.resolved,
+            "prefetched": self.prefetched,
+            "fallbacks": self.fallbacks,
+        }
+
+contact_batcher = ContactBatcher(window=settings.CONTACT_BATCH_WINDOW, batch_size=settings.CONTACT_BATCH_SIZE)
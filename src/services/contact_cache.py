@@ -0,0 +1,155 @@
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Optional
+from src.config import settings
+from src.services.phone import to_e164
+from src.services import metrics
+
+logger = logging.getLogger(__name__)
+
+_hit_metric = metrics.cache_requests.labels("contact", "hit")
+_miss_metric = metrics.cache_requests.labels("contact", "miss")
+
+class ContactCache:
+    """
+    In-process LRU cache with TTL mapping Landbot IDs and phones (E.164) to HubSpot Contact IDs.
+    Optionally backed by a local SQLite file so entries survive restarts.
+    """
+    def __init__(self, max_size: int = 10000, ttl: float = 86400, db_path: str = ""):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple[str, float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS contact_cache (key TEXT PRIMARY KEY, contact_id TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._db.commit()
+            logger.info(f"Contact cache persisted to {db_path}")
+
+    @staticmethod
+    def landbot_key(landbot_id: str) -> str:
+        return f"landbot:{landbot_id}"
+
+    @staticmethod
+    def phone_key(phone: str) -> Optional[str]:
+        # E.164, so "+34 600..." and "600..." share a key
+        normalized = to_e164(phone)
+        return f"phone:{normalized}" if normalized else None
+
+    def _keys(self, landbot_id: Optional[str], phone: Optional[str]) -> list:
+        keys = []
+        if landbot_id:
+            keys.append(self.landbot_key(landbot_id))
+        phone_key = self.phone_key(phone)
+        if phone_key:
+            keys.append(phone_key)
+        return keys
+
+    def _get(self, key: str) -> Optional[str]:
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry:
+            contact_id, expires_at = entry
+            if expires_at > now:
+                self._entries.move_to_end(key)
+                return contact_id
+            del self._entries[key]
+
+        if self._db is not None:
+            row = self._db.execute(
+                "SELECT contact_id, expires_at FROM contact_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row and row[1] > time.time():
+                # Promote to memory, keeping the remaining lifetime
+                self._put_memory(key, row[0], now + (row[1] - time.time()))
+                return row[0]
+        return None
+
+    def _put_memory(self, key: str, contact_id: str, expires_at: float):
+        self._entries[key] = (contact_id, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, landbot_id: Optional[str] = None, phone: Optional[str] = None) -> Optional[str]:
+        """
+        Look up a Contact ID by Landbot ID first, then by phone.
+        """
+        for key in self._keys(landbot_id, phone):
+            contact_id = self._get(key)
+            if contact_id:
+                self.hits += 1
+                _hit_metric.inc()
+                return contact_id
+        self.misses += 1
+        _miss_metric.inc()
+        return None
+
+    def contains(self, landbot_id: Optional[str] = None, phone: Optional[str] = None) -> bool:
+        """
+        Whether the customer is cached, without counting a lookup (used for prefetching).
+        """
+        return any(self._get(key) for key in self._keys(landbot_id, phone))
+
+    def set(self, contact_id: str, landbot_id: Optional[str] = None, phone: Optional[str] = None):
+        """
+        Store a resolved Contact ID under every key we know for the customer.
+        """
+        self.set_many([(contact_id, landbot_id, phone)])
+
+    def set_many(self, contacts: list):
+        """
+        Store several (contact_id, landbot_id, phone) entries with a single commit.
+        """
+        expires_at = time.monotonic() + self.ttl
+        rows = []
+        for contact_id, landbot_id, phone in contacts:
+            for key in self._keys(landbot_id, phone):
+                self._put_memory(key, contact_id, expires_at)
+                rows.append((key, contact_id))
+
+        if self._db is not None and rows:
+            wall_expires_at = time.time() + self.ttl
+            self._db.executemany(
+                "INSERT OR REPLACE INTO contact_cache (key, contact_id, expires_at) VALUES (?, ?, ?)",
+                [(key, contact_id, wall_expires_at) for key, contact_id in rows]
+            )
+            self._db.commit()
+
+    def invalidate(self, landbot_id: Optional[str] = None, phone: Optional[str] = None):
+        keys = self._keys(landbot_id, phone)
+        for key in keys:
+            self._entries.pop(key, None)
+        if self._db is not None and keys:
+            self._db.executemany("DELETE FROM contact_cache WHERE key = ?", [(key,) for key in keys])
+            self._db.commit()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+        }
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+contact_cache = ContactCache(
+    max_size=settings.CONTACT_CACHE_SIZE,
+    ttl=settings.CONTACT_CACHE_TTL,
+    db_path=settings.CONTACT_CACHE_DB,
+)
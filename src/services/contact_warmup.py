@@ -0,0 +1,102 @@
+import asyncio
+import logging
+from typing import Optional
+import httpx
+from src.config import settings
+from src.services.contact_cache import contact_cache
+from src.services.hubspot_service import hubspot_service
+from src.services.http_client import HUBSPOT
+from src.services.rate_limiter import rate_limiter, SEARCH
+
+logger = logging.getLogger(__name__)
+
+# HubSpot search cannot page past this many results
+SEARCH_RESULT_LIMIT = 10000
+
+class ContactWarmup:
+    """
+    Background job that loads the most recently active HubSpot contacts with a
+    Landbot ID into the contact cache, at startup and then every `interval`
+    seconds, so the first message after a deploy is served from the cache.
+
+    Pages are streamed into the cache one at a time and only fetched while the
+    search rate budget has headroom, so live lookups keep priority.
+    """
+    def __init__(self, interval: float = 3600, max_contacts: int = 5000, page_size: int = 200):
+        self.interval = interval
+        self.max_contacts = min(max_contacts, SEARCH_RESULT_LIMIT)
+        self.page_size = page_size
+        self._task: Optional[asyncio.Task] = None
+        self.runs = 0
+        self.loaded = 0
+
+    async def _wait_for_headroom(self):
+        bucket = rate_limiter.bucket(HUBSPOT, SEARCH)
+        while not bucket.has_headroom():
+            await asyncio.sleep(bucket.interval)
+
+    async def warm(self) -> int:
+        """
+        Load up to max_contacts contacts into the cache. Returns how many were loaded.
+        """
+        if not hubspot_service.landbot_property_available:
+            return 0
+        loaded = 0
+        await self._wait_for_headroom()
+        pages = hubspot_service.iter_contacts_with_property(
+            settings.PROP_LANDBOT_ID, [settings.PROP_LANDBOT_ID, "phone"], page_size=self.page_size
+        )
+        try:
+            async for page in pages:
+                page = page[:self.max_contacts - loaded]
+                contact_cache.set_many([
+                    (contact["id"], contact["properties"].get(settings.PROP_LANDBOT_ID), contact["properties"].get("phone"))
+                    for contact in page
+                ])
+                loaded += len(page)
+                if loaded >= self.max_contacts:
+                    break
+                await self._wait_for_headroom()
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 400:
+                hubspot_service.mark_landbot_property_missing()
+            else:
+                raise
+        finally:
+            await pages.aclose()
+        self.runs += 1
+        self.loaded = loaded
+        return loaded
+
+    async def _run(self):
+        while True:
+            try:
+                loaded = await self.warm()
+                if loaded:
+                    logger.info(f"Contact cache warmed with {loaded} HubSpot contacts.")
+            except Exception as e:
+                logger.warning(f"Contact cache warm-up failed: {e}")
+            if self.interval <= 0:
+                return
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        return {"runs": self.runs, "last_loaded": self.loaded}
+
+contact_warmup = ContactWarmup(
+    interval=settings.CONTACT_WARMUP_INTERVAL,
+    max_contacts=settings.CONTACT_WARMUP_MAX,
+)
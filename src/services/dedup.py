@@ -0,0 +1,75 @@
+import hashlib
+import time
+from collections import deque
+from typing import Optional, Tuple
+from src.config import settings
+from src.models import LandbotMessage
+
+def content_key(source: str, *parts) -> str:
+    """
+    Stable key for a message without an upstream id.
+    """
+    digest = hashlib.sha1("\x1f".join("" if part is None else str(part) for part in parts).encode()).hexdigest()
+    return f"{source}:sha1:{digest}"
+
+class TimeBucketedSet:
+    """
+    Set of recently seen keys that forgets them after roughly `ttl` seconds.
+
+    Keys live in a ring of `buckets` sets, one per time slice; whole slices are
+    dropped as they age out, so memory is bounded by the traffic of one TTL window
+    (and by max_size). Used as the in-process front of the shared dedup table.
+    """
+    def __init__(self, ttl: float, buckets: int = 10, max_size: int = 100000):
+        self.bucket_width = ttl / buckets
+        self.buckets = buckets
+        self.max_size = max_size
+        self._ring: deque = deque()
+        self._size = 0
+
+    def _rotate(self):
+        current = int(time.monotonic() // self.bucket_width)
+        while self._ring and self._ring[0][0] <= current - self.buckets:
+            _, expired = self._ring.popleft()
+            self._size -= len(expired)
+        if not self._ring or self._ring[-1][0] != current:
+            self._ring.append((current, set()))
+
+    def __contains__(self, key: str) -> bool:
+        self._rotate()
+        return any(key in keys for _, keys in self._ring)
+
+    def add(self, key: str):
+        self._rotate()
+        if self._size >= self.max_size and len(self._ring) > 1:
+            # Over budget: forget the oldest slice early; the shared table still has it
+            _, oldest = self._ring.popleft()
+            self._size -= len(oldest)
+        self._ring[-1][1].add(key)
+        self._size += 1
+
+    def __len__(self) -> int:
+        return self._size
+
+def landbot_message_key(message: LandbotMessage) -> Tuple[str, float]:
+    """
+    Dedup key and TTL for a Landbot message. Without an id or timestamp only
+    a short window is deduplicated, so a customer can still repeat "Si".
+    """
+    message_id = message.message_id
+    if message_id:
+        return f"landbot:{message_id}", settings.DEDUP_TTL
+    ttl = settings.DEDUP_TTL if message.timestamp is not None else settings.DEDUP_CONTENT_TTL
+    return content_key("landbot", message.customer.id, message.text, message.timestamp), ttl
+
+def hubspot_message_key(message_id: Optional[str], thread_ids: list, text: Optional[str], created_at: Optional[str]) -> Tuple[str, float]:
+    """
+    Dedup key and TTL for a HubSpot outgoing message.
+    """
+    if message_id:
+        return f"hubspot:{message_id}", settings.DEDUP_TTL
+    ttl = settings.DEDUP_TTL if created_at is not None else settings.DEDUP_CONTENT_TTL
+    return content_key("hubspot", ",".join(thread_ids), text, created_at), ttl
+
+# In-process front of the shared dedup table in the outbox
+recent_messages = TimeBucketedSet(settings.DEDUP_TTL, max_size=settings.DEDUP_MEMORY_SIZE)
@@ -0,0 +1,168 @@
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import sysconfig
+import threading
+import time
+import traceback
+from collections import Counter
+from typing import Optional
+from src.config import settings
+from src.services import metrics
+
+logger = logging.getLogger(__name__)
+
+# Stripped from file names so stacks stay short and stable across machines:
+# "src/services/outbox.py", "httpx/_client.py", "asyncio/base_events.py"
+_PATH_PREFIXES = sorted({
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) + os.sep,
+    *(path + os.sep for path in sysconfig.get_paths().values()),
+}, key=len, reverse=True)
+
+def _frame_label(frame) -> str:
+    filename = frame.f_code.co_filename
+    for prefix in _PATH_PREFIXES:
+        if filename.startswith(prefix):
+            filename = filename[len(prefix):]
+            break
+    return f"{filename}:{frame.f_code.co_name}"
+
+def _is_idle(frame) -> bool:
+    # The loop waiting for I/O: its innermost Python frame is the selector's select()
+    return frame.f_code.co_filename.endswith("selectors.py")
+
+class EventLoopMonitor:
+    """
+    Detects code that blocks the event loop.
+
+    A heartbeat task sleeps `interval` seconds at a time and records how late it
+    wakes up (the loop lag histogram). A watchdog thread checks the heartbeat; when
+    the loop has not run it for longer than `threshold`, it logs the stack the loop
+    thread is stuck in, which names the blocking call (sync I/O, heavy CPU work).
+    """
+    def __init__(self, interval: float = 0.1, threshold: float = 0.25):
+        self.interval = interval
+        self.threshold = threshold
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._loop_thread_id: Optional[int] = None
+        self._last_beat = time.monotonic()
+        self.stalls = 0
+        self.max_lag = 0.0
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            self._last_beat = time.monotonic()
+            lag = max(0.0, self._last_beat - expected)
+            self.max_lag = max(self.max_lag, lag)
+            metrics.event_loop_lag_seconds.observe(lag)
+
+    def _watch(self):
+        reported_beat = None
+        while not self._stopped.wait(self.interval):
+            beat = self._last_beat
+            blocked = time.monotonic() - beat
+            if blocked < self.threshold or beat == reported_beat:
+                continue
+            # One report per stall, with the stack at the moment it was detected
+            reported_beat = beat
+            self.stalls += 1
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame, limit=15)) if frame else "(stack unavailable)"
+            logger.warning(f"Event loop blocked for {blocked:.3f}s (threshold {self.threshold}s). Loop thread stack:\n{stack}")
+
+    def start(self):
+        if self.threshold <= 0 or (self._task is not None and not self._task.done()):
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self):
+        self._stopped.set()
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._watchdog:
+            self._watchdog.join(timeout=1)
+            self._watchdog = None
+
+    def stats(self) -> dict:
+        return {"stalls": self.stalls, "max_lag_ms": round(self.max_lag * 1000, 1)}
+
+class ProfileBusy(Exception):
+    pass
+
+class Profiler:
+    """
+    Time-boxed profiles of the running worker, one at a time.
+
+    "sample" mode reads the event loop thread's stack from a side thread every
+    few milliseconds and returns collapsed stacks (one "frame;frame;... count"
+    line per stack, the input of flamegraph.pl and speedscope). It covers every
+    request handler and background task on the loop at negligible cost; samples
+    where the loop is waiting for I/O are counted as "(idle)".
+    "cprofile" mode runs cProfile on the loop thread for the duration and returns
+    pstats text; exact call counts, but noticeably slower while it runs.
+    """
+    def __init__(self):
+        self._lock = asyncio.Lock()
+
+    async def profile(self, mode: str, seconds: float, interval: float = 0.005, top: int = 50) -> str:
+        if self._lock.locked():
+            raise ProfileBusy("A profile is already running")
+        async with self._lock:
+            if mode == "cprofile":
+                return await self._cprofile(seconds, top)
+            return await self._sample(seconds, interval)
+
+    async def _sample(self, seconds: float, interval: float) -> str:
+        loop_thread_id = threading.get_ident()
+
+        def sample() -> Counter:
+            stacks: Counter = Counter()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                frame = sys._current_frames().get(loop_thread_id)
+                if frame is not None:
+                    if _is_idle(frame):
+                        stacks["(idle)"] += 1
+                    else:
+                        labels = []
+                        while frame is not None:
+                            labels.append(_frame_label(frame))
+                            frame = frame.f_back
+                        stacks[";".join(reversed(labels))] += 1
+                time.sleep(interval)
+            return stacks
+
+        stacks = await asyncio.to_thread(sample)
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+    async def _cprofile(self, seconds: float, top: int) -> str:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(top)
+        return output.getvalue()
+
+loop_monitor = EventLoopMonitor(interval=settings.LOOP_MONITOR_INTERVAL, threshold=settings.LOOP_BLOCK_THRESHOLD)
+profiler = Profiler()
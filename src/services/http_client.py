@@ -0,0 +1,86 @@
+import httpx
+import logging
+from typing import Dict
+from src.config import settings
+
+logger = logging.getLogger(__name__)
+
+HUBSPOT = "hubspot"
+LANDBOT = "landbot"
+
+# Base URL used to pre-open a connection for each upstream at startup
+WARMUP_URLS = {
+    HUBSPOT: settings.HUBSPOT_API_URL,
+    LANDBOT: settings.LANDBOT_API_URL,
+}
+
+_clients: Dict[str, httpx.AsyncClient] = {}
+
+def _build_client(upstream: str) -> httpx.AsyncClient:
+    """
+    Build the pooled client for an upstream from its settings.
+    """
+    if upstream == HUBSPOT:
+        max_connections = settings.HUBSPOT_MAX_CONNECTIONS
+        max_keepalive = settings.HUBSPOT_MAX_KEEPALIVE
+        keepalive_expiry = settings.HUBSPOT_KEEPALIVE_EXPIRY
+        http2 = settings.HUBSPOT_HTTP2
+        timeout = httpx.Timeout(settings.HUBSPOT_READ_TIMEOUT, connect=settings.HUBSPOT_CONNECT_TIMEOUT)
+    elif upstream == LANDBOT:
+        max_connections = settings.LANDBOT_MAX_CONNECTIONS
+        max_keepalive = settings.LANDBOT_MAX_KEEPALIVE
+        keepalive_expiry = settings.LANDBOT_KEEPALIVE_EXPIRY
+        http2 = settings.LANDBOT_HTTP2
+        timeout = httpx.Timeout(settings.LANDBOT_READ_TIMEOUT, connect=settings.LANDBOT_CONNECT_TIMEOUT)
+    else:
+        raise ValueError(f"Unknown upstream: {upstream}")
+
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.warning(f"HTTP/2 requested for {upstream} but 'h2' is not installed. Falling back to HTTP/1.1.")
+            http2 = False
+
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_keepalive,
+        keepalive_expiry=keepalive_expiry,
+    )
+    return httpx.AsyncClient(limits=limits, http2=http2, timeout=timeout)
+
+def get_http_client(upstream: str) -> httpx.AsyncClient:
+    """
+    Return the long-lived pooled client for an upstream, creating it on first use.
+    Connections are kept alive between calls so each message does not pay
+    a new TCP + TLS handshake.
+    """
+    client = _clients.get(upstream)
+    if client is None or client.is_closed:
+        client = _build_client(upstream)
+        _clients[upstream] = client
+    return client
+
+async def open_http_clients():
+    """
+    Create the upstream pools and open a first keep-alive connection to each one.
+    Called on app startup.
+    """
+    for upstream, url in WARMUP_URLS.items():
+        client = get_http_client(upstream)
+        try:
+            await client.head(url)
+            logger.info(f"Connection pool for {upstream} ready.")
+        except httpx.HTTPError as e:
+            # Not fatal: the pool will connect lazily on the first real call
+            logger.warning(f"Could not pre-open connection to {upstream}: {e}")
+
+async def close_http_clients():
+    """
+    Close all upstream pools and release their connections. Called on app shutdown.
+    """
+    for upstream, client in list(_clients.items()):
+        if not client.is_closed:
+            await client.aclose()
+            logger.info(f"Connection pool for {upstream} closed.")
+    _clients.clear()
@@ -1,111 +1,333 @@
-from typing import Optional
-from hubspot import HubSpot
-from hubspot.crm.contacts import SimplePublicObjectInputForCreate as ContactInput, PublicObjectSearchRequest as ContactSearchRequest
+from typing import Dict, Optional
 from src.config import settings
-import requests
-import json
+from src.logging_config import LazyJson
+from src.services.http_client import get_http_client, HUBSPOT
+from src.services.contact_cache import contact_cache
+from src.services.phone import to_e164, phone_variants
+from src.services.token_store import build_token_store, token_is_fresh
+from src.services.rate_limiter import rate_limiter, SEARCH, CONVERSATIONS, ASSOCIATIONS, CRM
+from src.services.retry import send_with_retry, idempotency
+from src.services.circuit_breaker import circuit_breakers
+from src.services import metrics
+import asyncio
+import httpx
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 
 logger = logging.getLogger(__name__)
 
+HUBSPOT_API_URL = settings.HUBSPOT_API_URL
+
 class HubSpotService:
     def __init__(self):
         self._access_token = None
         self._token_expires_at = datetime.min
-        # Initialize client without token initially, or with a dummy one
-        self.client = HubSpot()
+        self._refresh_lock = asyncio.Lock()
+        # Shared with the other workers on this node so only one of them refreshes
+        self._token_store = build_token_store()
+        self._renewal_task: Optional[asyncio.Task] = None
+        # Whether the landbot_customer_id contact property exists; None until known
+        self._landbot_property: Optional[bool] = None
+        self._probe_task: Optional[asyncio.Task] = None
 
-    def _refresh_access_token(self) -> str:
+    async def _refresh_access_token(self) -> str:
         """
         Refresh the OAuth Access Token using the Refresh Token.
         """
         logger.info("Refreshing HubSpot Access Token...")
-        url = "https://api.hubapi.com/oauth/v1/token"
+        url = f"{HUBSPOT_API_URL}/oauth/v1/token"
         data = {
             "grant_type": "refresh_token",
             "client_id": settings.HUBSPOT_CLIENT_ID,
             "client_secret": settings.HUBSPOT_CLIENT_SECRET,
             "refresh_token": settings.HUBSPOT_REFRESH_TOKEN
         }
-        
+
         try:
-            response = requests.post(url, data=data)
-            response.raise_for_status()
+            with metrics.track(HUBSPOT, "token_refresh"):
+                response = await get_http_client(HUBSPOT).post(url, data=data)
+                response.raise_for_status()
             tokens = response.json()
-            
+
             self._access_token = tokens["access_token"]
             expires_in = tokens.get("expires_in", 1800)
             self._token_expires_at = datetime.now() + timedelta(seconds=expires_in - 60) # Buffer
-            
-            # Update client with new token
-            self.client.access_token = self._access_token
-            
+
             logger.info("Access Token refreshed successfully.")
             return self._access_token
         except Exception as e:
             logger.error(f"Failed to refresh token: {e}")
             raise e
 
-    def get_token(self) -> str:
+    def _token_is_valid(self) -> bool:
+        return bool(self._access_token) and datetime.now() < self._token_expires_at
+
+    def _adopt_token(self, token) -> str:
+        self._access_token, expires_at = token
+        self._token_expires_at = datetime.fromtimestamp(expires_at)
+        return self._access_token
+
+    async def _obtain_token(self, margin: float = 0) -> str:
+        """
+        Get a token valid for at least `margin` more seconds, reusing one another
+        worker already stored when possible. Caller must hold self._refresh_lock.
+        """
+        stored = self._token_store.load()
+        if token_is_fresh(stored, margin):
+            return self._adopt_token(stored)
+
+        async with self._token_store.lock():
+            # Another worker may have refreshed while we waited for the lock
+            stored = self._token_store.load()
+            if token_is_fresh(stored, margin):
+                return self._adopt_token(stored)
+            token = await self._refresh_access_token()
+            self._token_store.save(token, self._token_expires_at.timestamp())
+            return token
+
+    async def get_token(self) -> str:
         """
         Get a valid access token, refreshing if necessary.
+        Concurrent callers share a single in-flight refresh.
         """
-        if not self._access_token or datetime.now() >= self._token_expires_at:
-            return self._refresh_access_token()
-        return self._access_token
+        if self._token_is_valid():
+            return self._access_token
+        async with self._refresh_lock:
+            # Another caller may have refreshed while we waited for the lock
+            if self._token_is_valid():
+                return self._access_token
+            return await self._obtain_token()
+
+    async def _renew_token_loop(self):
+        """
+        Renew the token shortly before it expires so request paths never pay for a refresh.
+        """
+        while True:
+            if self._token_is_valid():
+                remaining = (self._token_expires_at - datetime.now()).total_seconds()
+                # Never renew more often than every half token lifetime
+                await asyncio.sleep(max(remaining - settings.HUBSPOT_TOKEN_RENEW_MARGIN, remaining / 2))
+            try:
+                async with self._refresh_lock:
+                    await self._obtain_token(margin=settings.HUBSPOT_TOKEN_RENEW_MARGIN)
+            except Exception:
+                # Already logged; try again shortly. get_token() still refreshes on demand.
+                await asyncio.sleep(settings.HUBSPOT_TOKEN_RETRY_DELAY)
+
+    def start_token_renewal(self):
+        if self._renewal_task is None or self._renewal_task.done():
+            self._renewal_task = asyncio.create_task(self._renew_token_loop())
+
+    async def stop_token_renewal(self):
+        if self._renewal_task:
+            self._renewal_task.cancel()
+            try:
+                await self._renewal_task
+            except asyncio.CancelledError:
+                pass
+            self._renewal_task = None
+
+    @property
+    def landbot_property_available(self) -> bool:
+        """
+        Whether searches and creates should use the landbot_customer_id property.
+        Until the probe has answered, assume it exists.
+        """
+        return self._landbot_property is not False
+
+    def _set_landbot_property(self, exists: bool):
+        if exists == self._landbot_property:
+            return
+        self._landbot_property = exists
+        if exists:
+            logger.info(f"Property '{settings.PROP_LANDBOT_ID}' found in HubSpot.")
+        else:
+            logger.warning(f"Property '{settings.PROP_LANDBOT_ID}' does not exist in HubSpot. Please create it manually. Using phone only until it does.")
+
+    def mark_landbot_property_missing(self):
+        """
+        Record a 400 caused by the missing property, so later messages skip it until the next probe.
+        """
+        self._set_landbot_property(False)
+
+    async def probe_landbot_property(self) -> Optional[bool]:
+        """
+        Check once whether the landbot_customer_id contact property exists.
+        """
+        try:
+            response = await self._request("GET", f"/crm/v3/properties/contacts/{settings.PROP_LANDBOT_ID}", operation="property_probe")
+        except Exception as e:
+            logger.warning(f"Could not check property '{settings.PROP_LANDBOT_ID}': {e}")
+            return self._landbot_property
+        if response.status_code == 200:
+            self._set_landbot_property(True)
+        elif response.status_code == 404:
+            self._set_landbot_property(False)
+        else:
+            # e.g. 403 without the schema read scope: keep learning from search responses instead
+            logger.warning(f"Could not check property '{settings.PROP_LANDBOT_ID}' ({response.status_code}).")
+        return self._landbot_property
+
+    async def _probe_property_loop(self):
+        while True:
+            await self.probe_landbot_property()
+            await asyncio.sleep(settings.HUBSPOT_PROPERTY_PROBE_INTERVAL)
+
+    def start_property_probe(self):
+        if self._probe_task is None or self._probe_task.done():
+            self._probe_task = asyncio.create_task(self._probe_property_loop())
+
+    async def stop_property_probe(self):
+        if self._probe_task:
+            self._probe_task.cancel()
+            try:
+                await self._probe_task
+            except asyncio.CancelledError:
+                pass
+            self._probe_task = None
+
+    async def _request(self, method: str, path: str, endpoint_class: str = CRM, idempotent: Optional[bool] = None,
+                       operation: str = "other", **kwargs) -> httpx.Response:
+        """
+        Send an authenticated request to the HubSpot API within the endpoint class rate budget.
+        Transient failures are retried; POSTs only when HubSpot certainly did not process them
+        unless the caller marks them idempotent. `operation` labels the latency metrics.
+        """
+        if idempotent is None:
+            idempotent = method in ("GET", "PUT", "DELETE", "HEAD")
+        token = await self.get_token()
+        headers = kwargs.pop("headers", {})
+        headers["Authorization"] = f"Bearer {token}"
+
+        async def send():
+            return await circuit_breakers[HUBSPOT].call(lambda: rate_limiter.request(
+                get_http_client(HUBSPOT), HUBSPOT, endpoint_class,
+                method, f"{HUBSPOT_API_URL}{path}", headers=headers, **kwargs
+            ))
+        with metrics.track(HUBSPOT, operation) as tracking:
+            response = await send_with_retry(send, idempotent, name=f"HubSpot {method} {path}", operation=operation)
+            tracking.response(response)
+            return response
+
+    async def _search_contact(self, property_name: str, value: str) -> Optional[str]:
+        """
+        Search for a single contact whose property equals value. Returns Contact ID or None.
+        """
+        payload = {
+            "filterGroups": [{"filters": [{"propertyName": property_name, "operator": "EQ", "value": value}]}],
+            "properties": ["firstname", "phone", settings.PROP_LANDBOT_ID]
+        }
+        response = await self._request("POST", "/crm/v3/objects/contacts/search", endpoint_class=SEARCH, idempotent=True,
+                                       operation="contact_search", json=payload)
+        response.raise_for_status()
+        results = response.json().get("results", [])
+        if results:
+            return results[0]["id"]
+        return None
+
+    async def _create_contact(self, properties: dict) -> str:
+        response = await self._request("POST", "/crm/v3/objects/contacts", operation="contact_create", json={"properties": properties})
+        response.raise_for_status()
+        return response.json()["id"]
+
+    async def search_contacts(self, property_name: str, values: list) -> Dict[str, str]:
+        """
+        Find contacts whose property is any of values (up to 100) in one search.
+        Returns {value: Contact ID}, first match per value.
+        """
+        found: Dict[str, str] = {}
+        payload = {
+            "filterGroups": [{"filters": [{"propertyName": property_name, "operator": "IN", "values": values}]}],
+            "properties": [property_name],
+            "limit": 200
+        }
+        while True:
+            response = await self._request("POST", "/crm/v3/objects/contacts/search", endpoint_class=SEARCH, idempotent=True,
+                                           operation="contact_search", json=payload)
+            response.raise_for_status()
+            body = response.json()
+            for result in body.get("results", []):
+                value = (result.get("properties") or {}).get(property_name)
+                if value is not None:
+                    found.setdefault(value, result["id"])
+            after = body.get("paging", {}).get("next", {}).get("after")
+            if not after:
+                return found
+            payload["after"] = after
 
-    def get_or_create_contact(self, name: str, phone: str, landbot_id: str = None) -> str:
+    async def iter_contacts_with_property(self, property_name: str, properties: list, page_size: int = 200):
+        """
+        Yield pages of contacts that have property_name set, most recently modified
+        first. Only one page is held at a time. HubSpot search stops at 10,000 results.
+        """
+        payload = {
+            "filterGroups": [{"filters": [{"propertyName": property_name, "operator": "HAS_PROPERTY"}]}],
+            "sorts": [{"propertyName": "lastmodifieddate", "direction": "DESCENDING"}],
+            "properties": properties,
+            "limit": page_size
+        }
+        while True:
+            response = await self._request("POST", "/crm/v3/objects/contacts/search", endpoint_class=SEARCH, idempotent=True,
+                                           operation="contact_search", json=payload)
+            response.raise_for_status()
+            body = response.json()
+            yield body.get("results", [])
+            after = body.get("paging", {}).get("next", {}).get("after")
+            if not after:
+                return
+            payload["after"] = after
+
+    async def create_contacts(self, properties_list: list) -> list:
+        """
+        Create up to 100 contacts in one call. Returns the created objects (with
+        their properties) in no particular order.
+        """
+        response = await self._request(
+            "POST", "/crm/v3/objects/contacts/batch/create", operation="contact_create",
+            json={"inputs": [{"properties": properties} for properties in properties_list]}
+        )
+        response.raise_for_status()
+        return response.json().get("results", [])
+
+    async def get_or_create_contact(self, name: str, phone: str, landbot_id: str = None, check_cache: bool = True) -> str:
         """
         Search for contact by phone or landbot_customer_id. If not found, create one.
-        Returns Contact ID.
-        """
-        # Ensure token is valid
-        self.get_token()
-        
-        # 1. Search by Phone or Landbot ID
-        filters = []
-        if phone:
-            filters.append({
-                "propertyName": "phone",
-                "operator": "EQ",
-                "value": phone
-            })
-        
-        if landbot_id:
-            filters.append({
-                "propertyName": settings.PROP_LANDBOT_ID,
-                "operator": "EQ",
-                "value": landbot_id
-            })
-
-        # We search with OR logic if possible, but HubSpot search filters are AND by default within a group.
+        Returns Contact ID. Callers that already missed the cache pass check_cache=False.
+        """
+        # 0. Warm conversations resolve locally without any network call
+        if check_cache:
+            cached_id = contact_cache.get(landbot_id=landbot_id, phone=phone)
+            if cached_id:
+                return cached_id
+
+        contact_id = await self._find_or_create_contact(name, phone, landbot_id)
+        contact_cache.set(contact_id, landbot_id=landbot_id, phone=phone)
+        return contact_id
+
+    async def _find_or_create_contact(self, name: str, phone: str, landbot_id: str = None) -> str:
+        # HubSpot search filters are AND by default within a group.
         # So we try search by Landbot ID first, then Phone.
-        
+
         contact_id = None
-        
+
         # Strategy A: Search by Landbot ID
-        if landbot_id:
-            filter_group = {"filters": [{"propertyName": settings.PROP_LANDBOT_ID, "operator": "EQ", "value": landbot_id}]}
-            search_req = ContactSearchRequest(filter_groups=[filter_group], properties=["firstname", "phone", settings.PROP_LANDBOT_ID])
+        if landbot_id and self.landbot_property_available:
             try:
-                search_res = self.client.crm.contacts.search_api.do_search(public_object_search_request=search_req)
-                if search_res.results:
-                    contact_id = search_res.results[0].id
-            except Exception as e:
-                if "PROPERTY_DOESNT_EXIST" in str(e) or "(400)" in str(e):
-                    logger.warning(f"Property '{settings.PROP_LANDBOT_ID}' does not exist in HubSpot. Please create it manually.")
+                contact_id = await self._search_contact(settings.PROP_LANDBOT_ID, landbot_id)
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code == 400:
+                    self.mark_landbot_property_missing()
                 else:
                     logger.warning(f"Search by {settings.PROP_LANDBOT_ID} failed: {e}")
+            except Exception as e:
+                logger.warning(f"Search by {settings.PROP_LANDBOT_ID} failed: {e}")
 
-        # Strategy B: Search by Phone
+        # Strategy B: Search by Phone, in every form it may have been stored
         if not contact_id and phone:
-            filter_group = {"filters": [{"propertyName": "phone", "operator": "EQ", "value": phone}]}
-            search_req = ContactSearchRequest(filter_groups=[filter_group], properties=["firstname", "phone", settings.PROP_LANDBOT_ID])
             try:
-                search_res = self.client.crm.contacts.search_api.do_search(public_object_search_request=search_req)
-                if search_res.results:
-                    contact_id = search_res.results[0].id
+                variants = phone_variants(phone)
+                by_phone = await self.search_contacts("phone", variants)
+                contact_id = next((by_phone[variant] for variant in variants if variant in by_phone), None)
             except Exception as e:
                 logger.warning(f"Search by phone failed: {e}")
 
@@ -113,49 +335,42 @@ class HubSpotService:
             # Optional: Update landbot_id on existing contact if missing
             return contact_id
 
-        # 2. Create if not found
+        # 2. Create if not found, with the phone in canonical form
+        phone = to_e164(phone) or phone
         try:
             properties = {
                 "firstname": name,
                 "phone": phone
             }
-            if landbot_id:
+            if landbot_id and self.landbot_property_available:
                 properties[settings.PROP_LANDBOT_ID] = landbot_id
-                
-            contact_input = ContactInput(properties=properties)
-            create_res = self.client.crm.contacts.basic_api.create(simple_public_object_input_for_create=contact_input)
-            return create_res.id
-            
-        except Exception as e:
-            if "PROPERTY_DOESNT_EXIST" in str(e) or "(400)" in str(e):
-                logger.error(f"Failed to create/sync contact: Property '{settings.PROP_LANDBOT_ID}' is missing in HubSpot.")
+
+            return await self._create_contact(properties)
+
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 400 and settings.PROP_LANDBOT_ID in properties:
+                self.mark_landbot_property_missing()
                 # Try creating without the custom property as fallback
                 try:
-                    properties = {"firstname": name, "phone": phone}
-                    contact_input = ContactInput(properties=properties)
-                    create_res = self.client.crm.contacts.basic_api.create(simple_public_object_input_for_create=contact_input)
-                    return create_res.id
-                except:
+                    return await self._create_contact({"firstname": name, "phone": phone})
+                except Exception:
                     pass
             logger.error(f"Error in creating contact: {e}")
             raise e
+        except Exception as e:
+            logger.error(f"Error in creating contact: {e}")
+            raise e
 
-    def publish_message_to_channel(self, landbot_id: int, message_text: str, sender_name: str = "Visitor", phone: str = None):
+    async def publish_message_to_channel(self, landbot_id: int, message_text: str, sender_name: str = "Visitor", phone: str = None,
+                                         timestamp: Optional[float] = None):
         """
         Publish a message to the HubSpot Custom Channel.
         Identifies the conversation thread by landbot_id.
         """
-        token = self.get_token()
-        
-        url = f"https://api.hubapi.com/conversations/v3/custom-channels/{settings.HUBSPOT_CHANNEL_ID}/messages"
-        
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json"
-        }
-        
+        path = f"/conversations/v3/custom-channels/{settings.HUBSPOT_CHANNEL_ID}/messages"
+
         # Prepare Sender info
-        # We MUST use the landbot_id as the delivery identifier so that 
+        # We MUST use the landbot_id as the delivery identifier so that
         # HubSpot's outbound webhooks return it to us, allowing us to route back to Landbot.
         delivery_identifier = {
             "type": "CHANNEL_SPECIFIC_OPAQUE_ID",
@@ -175,67 +390,75 @@ class HubSpotService:
                 }
             ]
         }
-        
-        logger.info(f"Publishing message to HubSpot: {json.dumps(payload)}")
-        
+        if timestamp:
+            # Keep the time the customer sent it, not the time we got to publish it
+            if timestamp > 1e11:
+                timestamp /= 1000  # Landbot sent milliseconds
+            payload["timestamp"] = datetime.fromtimestamp(timestamp, tz=timezone.utc).isoformat()
+
+        # A re-run of the same outbox job must not post the message twice
+        published = idempotency.lookup("hubspot_publish")
+        if published is not None:
+            logger.info("Message for %s already published, skipping.", landbot_id)
+            return published
+
+        logger.info("Publishing message to HubSpot: %s", LazyJson(payload))
+
         try:
-            response = requests.post(url, headers=headers, json=payload)
+            response = await self._request("POST", path, endpoint_class=CONVERSATIONS, operation="publish", json=payload)
             if response.status_code >= 400:
                 logger.error(f"❌ HubSpot API Error ({response.status_code}): {response.text}")
             response.raise_for_status()
             logger.info("Message published successfully.")
-            return response.json()
-        except requests.exceptions.HTTPError as e:
+            result = response.json()
+            idempotency.record("hubspot_publish", result)
+            return result
+        except httpx.HTTPStatusError as e:
             raise e
         except Exception as e:
             logger.error(f"Unexpected error publishing message: {e}")
             raise e
 
-    def get_thread_associated_ticket(self, thread_id: str) -> Optional[str]:
+    async def get_thread_associated_ticket(self, thread_id: str) -> Optional[str]:
         """
         Get the Ticket ID associated with a conversation thread.
         """
-        token = self.get_token()
-        url = f"https://api.hubapi.com/conversations/v3/conversations/threads/{thread_id}"
+        path = f"/conversations/v3/conversations/threads/{thread_id}"
         params = {"association": "ticket"}
-        headers = {"Authorization": f"Bearer {token}"}
-        
-        logger.info(f"Checking for ticket associated with thread {thread_id}...")
+
+        logger.info("Checking for ticket associated with thread %s...", thread_id)
         try:
-            response = requests.get(url, headers=headers, params=params)
+            response = await self._request("GET", path, endpoint_class=CONVERSATIONS, operation="thread_lookup", params=params)
             response.raise_for_status()
             data = response.json()
-            
+
             # The structure is usually threadAssociations: { associatedTicketId: "..." }
             associations = data.get("threadAssociations", {})
             ticket_id = associations.get("associatedTicketId")
             if ticket_id:
-                logger.info(f"Found associated ticket: {ticket_id}")
+                logger.info("Found associated ticket: %s", ticket_id)
             else:
-                logger.info(f"No ticket associated with thread {thread_id} yet. Thread data: {json.dumps(data)}")
+                logger.info("No ticket associated with thread %s yet.", thread_id)
+                logger.debug("Thread data: %s", LazyJson(data))
             return ticket_id
         except Exception as e:
             logger.error(f"Error fetching thread ticket: {e}")
             return None
 
-    def associate_contact_with_ticket(self, contact_id: str, ticket_id: str):
+    async def associate_contact_with_ticket(self, contact_id: str, ticket_id: str):
         """
         Explicitly associate a contact with a ticket.
         """
-        token = self.get_token()
-        url = f"https://api.hubapi.com/crm/v3/objects/contacts/{contact_id}/associations/tickets/{ticket_id}/contact_to_ticket"
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json"
-        }
-        
+        path = f"/crm/v3/objects/contacts/{contact_id}/associations/tickets/{ticket_id}/contact_to_ticket"
+        headers = {"Content-Type": "application/json"}
+
         try:
             # PUT endpoint for association v3
-            response = requests.put(url, headers=headers)
+            response = await self._request("PUT", path, endpoint_class=ASSOCIATIONS, operation="association", headers=headers)
             if response.status_code >= 400:
                 logger.error(f"❌ Association Error ({response.status_code}): {response.text}")
             response.raise_for_status()
-            logger.info(f"Successfully associated contact {contact_id} with ticket {ticket_id}")
+            logger.info("Successfully associated contact %s with ticket %s", contact_id, ticket_id)
             return True
         except Exception as e:
             logger.error(f"Failed to associate contact with ticket: {e}")
@@ -1,41 +1,63 @@
-import requests
+import httpx
 import logging
 from src.config import settings
+from src.logging_config import LazyJson
+from src.services.http_client import get_http_client, LANDBOT
+from src.services.rate_limiter import rate_limiter, MESSAGES
+from src.services.retry import send_with_retry, idempotency
+from src.services.circuit_breaker import circuit_breakers
+from src.services import metrics
 
 logger = logging.getLogger(__name__)
 
 class LandbotService:
     def __init__(self):
-        self.base_url = "https://api.landbot.io/v1"
+        self.base_url = f"{settings.LANDBOT_API_URL}/v1"
         self.headers = {
             "Authorization": f"Token {settings.LANDBOT_API_TOKEN}",
             "Content-Type": "application/json"
         }
 
-    def send_text_message(self, landbot_id: int, message: str):
+    async def send_text_message(self, landbot_id: int, message: str):
         """
         Send a text message to a Landbot user.
         WARNING: For WhatsApp, this only works within the 24h session window.
         """
         # Ensure correct URL format with trailing slash
-        url = f"https://api.landbot.io/v1/customers/{landbot_id}/send_text/"
+        url = f"{self.base_url}/customers/{landbot_id}/send_text/"
         payload = {
             "message": message,
             "extra": {
                 "sender": "agent"
             }
         }
-        
-        logger.info(f"Sending message to Landbot ({landbot_id}): {message}")
+
+        # A re-run of the same outbox job must not send the message twice
+        sent = idempotency.lookup("landbot_send_text")
+        if sent is not None:
+            logger.info("Message to Landbot (%s) already sent, skipping.", landbot_id)
+            return sent
+
+        logger.info("Sending message to Landbot (%s): %s", landbot_id, message)
+
+        async def send():
+            return await circuit_breakers[LANDBOT].call(lambda: rate_limiter.request(
+                get_http_client(LANDBOT), LANDBOT, MESSAGES,
+                "POST", url, json=payload, headers=self.headers
+            ))
+
         try:
-            response = requests.post(url, json=payload, headers=self.headers)
+            with metrics.track(LANDBOT, "send_text") as tracking:
+                response = await send_with_retry(send, idempotent=False, name=f"Landbot send_text {landbot_id}", operation="send_text")
+                tracking.response(response)
             if response.status_code >= 400:
                 logger.error(f"❌ Landbot API Error ({response.status_code}): {response.text}")
             response.raise_for_status()
             res_data = response.json()
-            logger.info(f"Message sent to Landbot successfully. Response: {res_data}")
+            logger.info("Message sent to Landbot successfully. Response: %s", LazyJson(res_data))
+            idempotency.record("landbot_send_text", res_data)
             return res_data
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             logger.error(f"Failed to send message to Landbot: {e}")
             raise e
 
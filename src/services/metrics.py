@@ -0,0 +1,149 @@
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Tuple
+# Loads .env, so PROMETHEUS_MULTIPROC_DIR set there is seen when prometheus_client is imported
+import src.config  # noqa: F401
+from src.services.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+try:
+    import prometheus_client
+    from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, multiprocess
+except ImportError:
+    prometheus_client = None
+
+# With several uvicorn workers, set PROMETHEUS_MULTIPROC_DIR to an empty directory
+# (wiped on deploy) so every worker writes its samples there and /metrics sums them.
+MULTIPROCESS = bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+
+# Upstream call latency; most calls take 50ms-2s, retries and rate-limit waits stretch the tail
+UPSTREAM_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60)
+# Webhook acks only enqueue, so they should stay in the low milliseconds
+ACK_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+# Extra delay of the event loop monitor's heartbeat; anything above a few ms means something blocked the loop
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+class _NoopMetric:
+    """
+    Stands in for every metric when prometheus_client is not installed.
+    """
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount: float = 1):
+        pass
+
+    def observe(self, value: float):
+        pass
+
+    def set(self, value: float):
+        pass
+
+if prometheus_client is not None:
+    # Skip the *_created series; they double the scrape size and nothing here uses them
+    prometheus_client.disable_created_metrics()
+    webhook_ack_seconds = Histogram(
+        "bridge_webhook_ack_seconds", "Time to acknowledge a webhook", ["route", "status"], buckets=ACK_BUCKETS
+    )
+    upstream_request_seconds = Histogram(
+        "bridge_upstream_request_seconds", "Upstream operation latency, including retries and rate-limit waits",
+        ["upstream", "operation", "outcome"], buckets=UPSTREAM_BUCKETS
+    )
+    upstream_retries = Counter("bridge_upstream_retries_total", "Upstream calls retried", ["operation"])
+    cache_requests = Counter("bridge_cache_requests_total", "Cache lookups", ["cache", "result"])
+    messages_dropped = Counter("bridge_messages_dropped_total", "Messages not forwarded", ["reason"])
+    outbox_jobs = Counter("bridge_outbox_jobs_total", "Outbox jobs finished", ["kind", "outcome"])
+    event_loop_lag_seconds = Histogram(
+        "bridge_event_loop_lag_seconds", "How late the event loop ran a scheduled heartbeat", buckets=LAG_BUCKETS
+    )
+    # Counted from the shared table at scrape time, so the freshest worker's value is the queue's depth
+    outbox_depth = Gauge("bridge_outbox_depth", "Jobs waiting in the outbox", multiprocess_mode="mostrecent")
+else:
+    logger.warning("prometheus_client is not installed; /metrics is disabled.")
+    webhook_ack_seconds = upstream_request_seconds = upstream_retries = _NoopMetric()
+    cache_requests = messages_dropped = outbox_jobs = outbox_depth = event_loop_lag_seconds = _NoopMetric()
+
+class _Tracking:
+    __slots__ = ("ok", "span")
+
+    def __init__(self, span):
+        self.ok = True
+        self.span = span
+
+    def response(self, response):
+        # HTTP errors are only raised later by raise_for_status()
+        self.ok = response.status_code < 400
+        self.span.attributes["status"] = response.status_code
+
+@contextmanager
+def track(upstream: str, operation: str):
+    """
+    Time an upstream operation, as a histogram sample and as a span of the current
+    trace. The outcome is "error" if the block raises or reports an HTTP error response:
+
+        with metrics.track(HUBSPOT, "publish") as tracking:
+            tracking.response(await send())
+    """
+    with tracer.span(f"{upstream}.{operation}") as span:
+        tracking = _Tracking(span)
+        start = time.perf_counter()
+        try:
+            yield tracking
+        except BaseException:
+            tracking.ok = False
+            raise
+        finally:
+            outcome = "ok" if tracking.ok else "error"
+            upstream_request_seconds.labels(upstream, operation, outcome).observe(time.perf_counter() - start)
+
+class AckLatencyMiddleware:
+    """
+    ASGI middleware recording how long each webhook takes to answer, per route.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith("/webhook"):
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The router stores the matched route in the scope; fall back to the raw path for 404s
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            webhook_ack_seconds.labels(path, str(status)).observe(time.perf_counter() - start)
+
+def render() -> Tuple[bytes, str]:
+    """
+    Current metrics in the Prometheus text format, summed over all workers in multiprocess mode.
+    """
+    if prometheus_client is None:
+        return b"", "text/plain"
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
+
+def mark_process_dead():
+    """
+    Drop this worker's live gauges from the shared directory on shutdown.
+    """
+    if prometheus_client is not None and MULTIPROCESS:
+        multiprocess.mark_process_dead(os.getpid())
@@ -0,0 +1,479 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+from src.config import settings
+from src.services.retry import is_retryable, message_deadline, idempotency_scope
+from src.services.circuit_breaker import CircuitOpenError
+from src.services import metrics
+from src.services.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+PROCESSING = "processing"
+DEAD = "dead"
+
+class OutboxFull(Exception):
+    pass
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class Outbox:
+    """
+    Durable local work queue backed by SQLite in WAL mode.
+
+    Webhook handlers append jobs with enqueue(); appends from concurrent requests
+    are grouped into a single transaction (group commit) and each caller returns
+    once its job is on disk. Each job kind has its own pool of async consumers, so
+    jobs waiting on one upstream (rate limits, retries) never hold up another kind.
+
+    Jobs that share a key (one conversation) run strictly in enqueue order: only
+    the oldest unfinished job of each key can be claimed, so a conversation never
+    has two jobs in flight, while different conversations run in parallel up to
+    the number of consumers of their kind. The claim happens in the database, so
+    this also holds across workers.
+    Claimed jobs left behind by a crashed or redeployed worker are reclaimed once
+    that worker is gone (or after OUTBOX_VISIBILITY_TIMEOUT), so work survives restarts.
+
+    Kinds registered with a coalesce window are held back for that window after
+    their last enqueue; jobs arriving for the same key meanwhile are merged into
+    the waiting one instead of becoming jobs of their own.
+    """
+    def __init__(self, db_path: str, consumers: int = 8, batch_size: int = 100,
+                 flush_interval: float = 0.002, poll_interval: float = 1.0,
+                 max_pending: int = 100000, max_attempts: int = 5, visibility_timeout: float = 300):
+        self.db_path = db_path
+        self.consumers = consumers
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.poll_interval = poll_interval
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.visibility_timeout = visibility_timeout
+        self._handlers: Dict[str, Tuple[Callable[..., Awaitable], Optional[type]]] = {}
+        self._prefetch: Dict[str, Callable[[dict], None]] = {}
+        self._coalesce: Dict[str, Tuple[Callable[[dict, dict], dict], float, float]] = {}
+        self._db: Optional[sqlite3.Connection] = None
+        self._inserts: list = []
+        self._acks: list = []
+        self._retries: list = []
+        self._batch_done: Optional[asyncio.Future] = None
+        self._flush_wakeup: Optional[asyncio.Event] = None
+        self._fetch_wakeup: Optional[asyncio.Event] = None
+        self._consumers: Dict[str, int] = {}
+        self._queues: Dict[str, asyncio.Queue] = {}
+        self._tasks: list = []
+        self.depth = 0
+        self.processed = 0
+        self.failed = 0
+        self.duplicates = 0
+        self.coalesced = 0
+
+    def register(self, kind: str, handler: Callable[..., Awaitable], record: Optional[type] = None,
+                 coalesce: Optional[Callable[[dict, dict], dict]] = None, window: float = 0, max_wait: float = 0,
+                 consumers: Optional[int] = None, prefetch: Optional[Callable[[dict], None]] = None):
+        """
+        Register the coroutine that runs jobs of this kind. It is called with the job
+        payload as kwargs, or with a single record(**payload) if a record type is given.
+        Jobs of this kind run on their own `consumers` tasks (default: the outbox's).
+        prefetch(payload), if given, is called as each job is claimed, before a consumer
+        is free to run it, to start work the job will need (e.g. batched lookups).
+
+        With coalesce and a window > 0, a keyed job waits until no new job for its key
+        has arrived for `window` seconds (at most `max_wait` after the first one);
+        coalesce(waiting_payload, new_payload) returns the merged payload.
+        """
+        self._handlers[kind] = (handler, record)
+        self._consumers[kind] = consumers or self.consumers
+        if prefetch:
+            self._prefetch[kind] = prefetch
+        if coalesce and window > 0:
+            self._coalesce[kind] = (coalesce, window, max(max_wait, window))
+
+    def _connect(self):
+        self._db = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("PRAGMA busy_timeout=5000")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                key TEXT,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                available_at REAL NOT NULL,
+                claimed_at REAL,
+                claimed_by INTEGER,
+                trace TEXT
+            )"""
+        )
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(outbox)")}
+        if "trace" not in columns:
+            # Queue files created before tracing
+            self._db.execute("ALTER TABLE outbox ADD COLUMN trace TEXT")
+        self._db.execute("CREATE INDEX IF NOT EXISTS outbox_ready ON outbox (status, available_at, id)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS outbox_key ON outbox (key, id)")
+        # Webhook message ids already accepted, shared by every worker using this file
+        self._db.execute("CREATE TABLE IF NOT EXISTS outbox_dedup (key TEXT PRIMARY KEY, expires_at REAL NOT NULL)")
+
+    async def enqueue(self, kind: str, payload: dict, key: Optional[str] = None,
+                      dedup_key: Optional[str] = None, dedup_ttl: float = 0) -> bool:
+        """
+        Durably append a job. Returns once the batch containing it has been committed.
+        Jobs with the same key are processed one at a time, in order.
+
+        With a dedup_key, the job is dropped if the same key was accepted within
+        dedup_ttl seconds (also by another worker); returns False in that case.
+        """
+        if self.depth >= self.max_pending:
+            metrics.messages_dropped.labels("outbox_full").inc()
+            raise OutboxFull(f"Outbox has {self.depth} pending jobs (limit {self.max_pending})")
+
+        if self._batch_done is None:
+            self._batch_done = asyncio.get_running_loop().create_future()
+        batch_done = self._batch_done
+        index = len(self._inserts)
+        dedup_expires_at = time.time() + dedup_ttl if dedup_key else None
+        self._inserts.append((
+            kind, key, json.dumps(payload, separators=(",", ":")), time.time(), dedup_key, dedup_expires_at, tracer.context()
+        ))
+        self.depth += 1
+        self._flush_wakeup.set()
+        duplicates = await batch_done
+        return index not in duplicates
+
+    def _insert_jobs(self, inserts: list) -> Tuple[set, int]:
+        """
+        Insert new jobs, skipping those whose dedup key is still live and merging
+        coalescable ones into a waiting job. Returns the skipped indexes and the merge count.
+        """
+        now = time.time()
+        duplicates = set()
+        merged = 0
+        for index, (kind, key, payload, created_at, dedup_key, dedup_expires_at, trace) in enumerate(inserts):
+            if dedup_key:
+                # Inserts the key, or revives it if expired; touches no row if it is a live duplicate
+                cursor = self._db.execute(
+                    """INSERT INTO outbox_dedup (key, expires_at) VALUES (?, ?)
+                    ON CONFLICT(key) DO UPDATE SET expires_at = excluded.expires_at WHERE outbox_dedup.expires_at < ?""",
+                    (dedup_key, dedup_expires_at, now)
+                )
+                if cursor.rowcount == 0:
+                    duplicates.add(index)
+                    continue
+            available_at = created_at
+            coalesce = self._coalesce.get(kind) if key is not None else None
+            if coalesce:
+                merge, window, max_wait = coalesce
+                if self._merge_into_waiting(kind, key, payload, now, merge, window, max_wait):
+                    merged += 1
+                    continue
+                available_at = created_at + window
+            self._db.execute(
+                "INSERT INTO outbox (kind, key, payload, created_at, available_at, trace) VALUES (?, ?, ?, ?, ?, ?)",
+                (kind, key, payload, created_at, available_at, trace)
+            )
+        return duplicates, merged
+
+    def _merge_into_waiting(self, kind: str, key: str, payload: str, now: float,
+                            merge: Callable[[dict, dict], dict], window: float, max_wait: float) -> bool:
+        """
+        Fold payload into the key's last job if it is still in its coalesce window.
+        Only never-run jobs qualify, so nothing already sent upstream is changed.
+        """
+        row = self._db.execute(
+            "SELECT id, kind, payload, status, attempts, created_at, available_at FROM outbox WHERE key = ? ORDER BY id DESC LIMIT 1",
+            (key,)
+        ).fetchone()
+        if row is None:
+            return False
+        job_id, last_kind, last_payload, status, attempts, created_at, available_at = row
+        if last_kind != kind or status != PENDING or attempts or available_at <= now:
+            return False
+        merged = merge(json.loads(last_payload), json.loads(payload))
+        self._db.execute(
+            "UPDATE outbox SET payload = ?, available_at = ? WHERE id = ?",
+            (json.dumps(merged, separators=(",", ":")), min(now + window, created_at + max_wait), job_id)
+        )
+        return True
+
+    def _flush(self):
+        """
+        Commit queued inserts, acks and retries in a single transaction.
+        """
+        inserts, self._inserts = self._inserts, []
+        acks, self._acks = self._acks, []
+        retries, self._retries = self._retries, []
+        batch_done, self._batch_done = self._batch_done, None
+        duplicates = set()
+        merged = 0
+        try:
+            self._db.execute("BEGIN IMMEDIATE")
+            if inserts:
+                duplicates, merged = self._insert_jobs(inserts)
+            if acks:
+                self._db.executemany("DELETE FROM outbox WHERE id = ?", [(job_id,) for job_id in acks])
+            if retries:
+                self._db.executemany(
+                    "UPDATE outbox SET status = ?, attempts = ?, available_at = ?, claimed_at = NULL, claimed_by = NULL WHERE id = ?",
+                    retries
+                )
+            self._db.execute("COMMIT")
+        except Exception as e:
+            self._db.execute("ROLLBACK")
+            self.depth -= len(inserts)
+            # Keep finished jobs' outcomes for the next flush; dropping them would leave the jobs claimed
+            self._acks = acks + self._acks
+            self._retries = retries + self._retries
+            if batch_done and not batch_done.done():
+                batch_done.set_exception(e)
+            raise
+        self.depth -= len(duplicates) + merged
+        self.duplicates += len(duplicates)
+        if duplicates:
+            metrics.messages_dropped.labels("duplicate").inc(len(duplicates))
+        self.coalesced += merged
+        if batch_done and not batch_done.done():
+            batch_done.set_result(duplicates)
+        if inserts or acks or retries:
+            # New work, or a finished job may have unblocked the next one in its conversation
+            self._fetch_wakeup.set()
+
+    async def _writer(self):
+        while True:
+            await self._flush_wakeup.wait()
+            # Give concurrent requests a moment to join the same commit
+            await asyncio.sleep(self.flush_interval)
+            self._flush_wakeup.clear()
+            try:
+                self._flush()
+            except Exception as e:
+                logger.error(f"❌ Outbox commit failed: {e}")
+
+    def _claim(self, limits: Dict[str, int]) -> list:
+        """
+        Claim up to limits[kind] ready jobs of each kind.
+        """
+        now = time.time()
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            rows = []
+            for kind, limit in limits.items():
+                # Only the oldest unfinished job of each key is claimable
+                rows += self._db.execute(
+                    """SELECT id, kind, payload, attempts, created_at, trace FROM outbox AS job
+                    WHERE status = ? AND kind = ? AND available_at <= ?
+                      AND (key IS NULL OR NOT EXISTS (
+                          SELECT 1 FROM outbox AS prev WHERE prev.key = job.key AND prev.id < job.id AND prev.status != ?
+                      ))
+                    ORDER BY id LIMIT ?""",
+                    (PENDING, kind, now, DEAD, limit)
+                ).fetchall()
+            if rows:
+                self._db.executemany(
+                    "UPDATE outbox SET status = ?, claimed_at = ?, claimed_by = ? WHERE id = ?",
+                    [(PROCESSING, now, os.getpid(), row[0]) for row in rows]
+                )
+            self._db.execute("COMMIT")
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+        return rows
+
+    def _release_own_claims(self) -> int:
+        """
+        Return jobs claimed under this PID to pending. At startup nothing can be in flight
+        yet, and a restarted container often reuses the PID of the process it replaces.
+        """
+        cursor = self._db.execute(
+            "UPDATE outbox SET status = ?, claimed_at = NULL, claimed_by = NULL WHERE status = ? AND claimed_by = ?",
+            (PENDING, PROCESSING, os.getpid())
+        )
+        return cursor.rowcount
+
+    def _reclaim_stale(self):
+        """
+        Return jobs claimed by a process that died before finishing them: either the
+        claiming worker on this node is gone, or the claim outlived the visibility timeout.
+        """
+        owners = [row[0] for row in self._db.execute(
+            "SELECT DISTINCT claimed_by FROM outbox WHERE status = ?", (PROCESSING,)
+        ).fetchall()]
+        dead_owners = [(pid,) for pid in owners if pid is not None and pid != os.getpid() and not _process_alive(pid)]
+        reclaimed = 0
+        if dead_owners:
+            cursor = self._db.executemany(
+                "UPDATE outbox SET status = 'pending', claimed_at = NULL, claimed_by = NULL WHERE status = 'processing' AND claimed_by = ?",
+                dead_owners
+            )
+            reclaimed += cursor.rowcount
+        cursor = self._db.execute(
+            "UPDATE outbox SET status = ?, claimed_at = NULL, claimed_by = NULL WHERE status = ? AND claimed_at < ?",
+            (PENDING, PROCESSING, time.time() - self.visibility_timeout)
+        )
+        reclaimed += cursor.rowcount
+        if reclaimed:
+            logger.warning(f"Reclaimed {reclaimed} stale outbox jobs.")
+        self._db.execute("DELETE FROM outbox_dedup WHERE expires_at < ?", (time.time(),))
+        self.recount()
+
+    def recount(self) -> int:
+        """
+        Re-read the depth from the table, which counts jobs queued by every worker.
+        """
+        if self._db is not None:
+            self.depth = self._db.execute("SELECT COUNT(*) FROM outbox WHERE status != ?", (DEAD,)).fetchone()[0]
+        return self.depth
+
+    async def _fetcher(self):
+        last_reclaim = 0.0
+        while True:
+            if time.monotonic() - last_reclaim > self.visibility_timeout / 2:
+                self._reclaim_stale()
+                last_reclaim = time.monotonic()
+
+            self._fetch_wakeup.clear()
+            # Claim only what each kind's queue can take, so a backed-up kind never blocks the others
+            limits = {kind: queue.maxsize - queue.qsize() for kind, queue in self._queues.items()}
+            limits = {kind: limit for kind, limit in limits.items() if limit > 0}
+            if limits:
+                for row in self._claim(limits):
+                    self._queues[row[1]].put_nowait(row)
+                    self._prefetch_job(row[1], row[2])
+            # Wake up for the next delayed job (coalesce window, retry) instead of the full poll interval
+            now = time.time()
+            next_due = self._db.execute(
+                "SELECT MIN(available_at) FROM outbox WHERE status = ? AND available_at > ?", (PENDING, now)
+            ).fetchone()[0]
+            timeout = self.poll_interval if next_due is None else min(self.poll_interval, next_due - now)
+            try:
+                await asyncio.wait_for(self._fetch_wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _prefetch_job(self, kind: str, payload: str):
+        prefetch = self._prefetch.get(kind)
+        if prefetch is None:
+            return
+        try:
+            prefetch(json.loads(payload))
+        except Exception as e:
+            # Only an optimization; the job itself reports real failures
+            logger.warning(f"Outbox prefetch for {kind} failed: {e}")
+
+    async def _consumer(self, jobs: asyncio.Queue):
+        while True:
+            job_id, kind, payload, attempts, created_at, trace = await jobs.get()
+            deadline = created_at + settings.MESSAGE_DEADLINE
+            # Let the services see which job they run for (retry deadline, idempotency keys)
+            deadline_token = message_deadline.set(deadline)
+            scope_token = idempotency_scope.set(f"outbox:{job_id}:{created_at}")
+            try:
+                handler, record = self._handlers[kind]
+                if not attempts:
+                    # Webhook receipt to first run: group commit, coalesce window and backlog
+                    tracer.record("outbox.queue_wait", created_at, trace, kind=kind)
+                with tracer.resume(trace, f"outbox.{kind}", job_id=job_id, attempt=attempts + 1):
+                    if record is not None:
+                        await handler(record(**json.loads(payload)))
+                    else:
+                        await handler(**json.loads(payload))
+                self._acks.append(job_id)
+                self.processed += 1
+                self.depth -= 1
+                metrics.outbox_jobs.labels(kind, "ok").inc()
+            except CircuitOpenError as e:
+                # Upstream is down: park the job until the breaker probes again, without using up an attempt
+                if e.retry_at > deadline:
+                    logger.error(f"❌ Outbox job {job_id} ({kind}) expired while {e.name} was unavailable.")
+                    self._retries.append((DEAD, attempts, time.time(), job_id))
+                    self.depth -= 1
+                    metrics.outbox_jobs.labels(kind, "dead").inc()
+                    metrics.messages_dropped.labels("expired").inc()
+                else:
+                    self._retries.append((PENDING, attempts, e.retry_at, job_id))
+            except Exception as e:
+                self.failed += 1
+                attempts += 1
+                retry_at = time.time() + 2 ** attempts
+                if attempts >= self.max_attempts or not is_retryable(e) or retry_at > deadline:
+                    logger.error(f"❌ Outbox job {job_id} ({kind}) failed {attempts} times, giving up: {e}")
+                    self._retries.append((DEAD, attempts, time.time(), job_id))
+                    self.depth -= 1
+                    metrics.outbox_jobs.labels(kind, "dead").inc()
+                    metrics.messages_dropped.labels("failed").inc()
+                else:
+                    logger.warning(f"Outbox job {job_id} ({kind}) failed (attempt {attempts}): {e}")
+                    self._retries.append((PENDING, attempts, retry_at, job_id))
+                    metrics.outbox_jobs.labels(kind, "retry").inc()
+            finally:
+                message_deadline.reset(deadline_token)
+                idempotency_scope.reset(scope_token)
+                self._flush_wakeup.set()
+                jobs.task_done()
+
+    async def start(self):
+        self._connect()
+        self._flush_wakeup = asyncio.Event()
+        self._fetch_wakeup = asyncio.Event()
+        self._queues = {kind: asyncio.Queue(maxsize=self.batch_size) for kind in self._handlers}
+        released = self._release_own_claims()
+        if released:
+            logger.warning(f"Released {released} outbox jobs left claimed by a previous process with this PID.")
+        self._reclaim_stale()
+        if self.depth:
+            logger.info(f"Outbox resuming with {self.depth} pending jobs.")
+        self._tasks = [asyncio.create_task(self._writer()), asyncio.create_task(self._fetcher())]
+        for kind, queue in self._queues.items():
+            self._tasks += [asyncio.create_task(self._consumer(queue)) for _ in range(self._consumers[kind])]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._db is not None:
+            # Persist acks and retries, then hand back jobs that were claimed but not finished
+            # (interrupted or still waiting in memory) so the next process picks them up at once
+            try:
+                self._flush()
+            except Exception as e:
+                logger.error(f"❌ Outbox commit failed on shutdown: {e}")
+            self._release_own_claims()
+            self._db.close()
+            self._db = None
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth,
+            "in_memory": {kind: queue.qsize() for kind, queue in self._queues.items()},
+            "processed": self.processed,
+            "failed": self.failed,
+            "duplicates": self.duplicates,
+            "coalesced": self.coalesced,
+        }
+
+outbox = Outbox(
+    db_path=settings.OUTBOX_DB,
+    consumers=settings.OUTBOX_CONSUMERS,
+    batch_size=settings.OUTBOX_BATCH_SIZE,
+    flush_interval=settings.OUTBOX_FLUSH_INTERVAL,
+    poll_interval=settings.OUTBOX_POLL_INTERVAL,
+    max_pending=settings.OUTBOX_MAX_PENDING,
+    max_attempts=settings.OUTBOX_MAX_ATTEMPTS,
+    visibility_timeout=settings.OUTBOX_VISIBILITY_TIMEOUT,
+)
@@ -0,0 +1,73 @@
+import logging
+import re
+from typing import Optional
+from src.config import settings
+
+logger = logging.getLogger(__name__)
+
+try:
+    import phonenumbers
+except ImportError:
+    phonenumbers = None
+
+def _default_region() -> Optional[str]:
+    if phonenumbers is None or not settings.PHONE_DEFAULT_COUNTRY_CODE:
+        return None
+    region = phonenumbers.region_code_for_country_code(int(settings.PHONE_DEFAULT_COUNTRY_CODE))
+    return None if region == "ZZ" else region
+
+def _parse_e164(phone: str, region: Optional[str]) -> Optional[str]:
+    try:
+        number = phonenumbers.parse(phone, region)
+    except phonenumbers.NumberParseException:
+        return None
+    if not phonenumbers.is_valid_number(number):
+        return None
+    return phonenumbers.format_number(number, phonenumbers.PhoneNumberFormat.E164)
+
+def to_e164(phone: Optional[str]) -> Optional[str]:
+    """
+    Canonical E.164 form ("+34600123456") of a phone as Landbot or HubSpot store it
+    ("+34 600 12 34 56", "0034600123456", "34600123456", or national "600123456").
+    Numbers without a country code get PHONE_DEFAULT_COUNTRY_CODE. Returns None for
+    numbers that cannot be validated or whose country is unknown.
+    """
+    if not phone:
+        return None
+    phone = phone.strip()
+    digits = re.sub(r"\D", "", phone)
+    if not digits:
+        return None
+
+    if phonenumbers is not None:
+        # As written (national numbers use the default region), then as an international number without "+"
+        return _parse_e164(phone, _default_region()) or _parse_e164(f"+{digits.removeprefix('00')}", None)
+
+    # Without phonenumbers, only trust a number whose country code is explicit or configured
+    if phone.startswith("+"):
+        return f"+{digits}"
+    if digits.startswith("00"):
+        return f"+{digits[2:]}"
+    country_code = settings.PHONE_DEFAULT_COUNTRY_CODE
+    if not country_code:
+        return None
+    if digits.startswith("0") or (len(digits) <= 10 and not digits.startswith(country_code)):
+        # National number; drop the trunk prefix ("0" in "07911...")
+        return f"+{country_code}{digits.lstrip('0')}"
+    return f"+{digits}"
+
+def phone_variants(phone: Optional[str]) -> list:
+    """
+    Forms the same number may be stored under in HubSpot, canonical first.
+    Used to match existing contacts created before phones were normalized.
+    """
+    if not phone:
+        return []
+    e164 = to_e164(phone)
+    variants = [e164, e164[1:]] if e164 else []
+    country_code = settings.PHONE_DEFAULT_COUNTRY_CODE
+    if e164 and country_code and e164.startswith(f"+{country_code}"):
+        variants.append(e164[1 + len(country_code):])
+    if re.search(r"\d", phone):
+        variants.append(phone.strip())
+    return list(dict.fromkeys(variant for variant in variants if variant))
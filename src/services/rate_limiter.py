@@ -0,0 +1,175 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional, Tuple
+import httpx
+from src.config import settings
+from src.services.http_client import HUBSPOT, LANDBOT
+
+logger = logging.getLogger(__name__)
+
+# Endpoint classes. HubSpot budgets search separately from the rest of the API.
+SEARCH = "search"
+CONVERSATIONS = "conversations"
+ASSOCIATIONS = "associations"
+CRM = "crm"
+MESSAGES = "messages"
+
+class RateLimitExceeded(Exception):
+    pass
+
+def parse_retry_after(headers: httpx.Headers) -> Optional[float]:
+    value = headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        # HTTP-date form is not used by HubSpot or Landbot; treat it as unknown
+        return None
+
+class TokenBucket:
+    """
+    Token bucket for one upstream endpoint class.
+
+    Starts from configured defaults and resizes itself from rate-limit response
+    headers. Callers that find the bucket empty wait for their slot instead of
+    failing, up to a deadline.
+    """
+    def __init__(self, name: str, capacity: float, interval: float):
+        self.name = name
+        self.capacity = capacity
+        self.interval = interval
+        self.tokens = capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self.throttled = 0
+        self.rejected = 0
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / self.interval
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, deadline: float):
+        """
+        Take one token, waiting for it if needed. Raises RateLimitExceeded if the
+        wait would go past deadline (a time.monotonic() value).
+        """
+        self._refill()
+        # Reserve the token now (tokens may go negative) so concurrent callers queue up behind us
+        self.tokens -= 1
+        now = time.monotonic()
+        wait = max(-self.tokens / self.rate if self.tokens < 0 else 0.0, self._blocked_until - now)
+        if wait <= 0:
+            return
+        if now + wait > deadline:
+            self.tokens += 1
+            self.rejected += 1
+            raise RateLimitExceeded(f"{self.name}: no budget for {wait:.1f}s")
+        self.throttled += 1
+        await asyncio.sleep(wait)
+
+    def has_headroom(self, fraction: float = 0.5) -> bool:
+        """
+        Whether more than `fraction` of the budget is unused. Background jobs wait
+        for this so they never compete with live traffic for the last tokens.
+        """
+        self._refill()
+        return self.tokens > self.capacity * fraction
+
+    def update_from_headers(self, headers: httpx.Headers):
+        """
+        Resize from HubSpot (X-HubSpot-RateLimit-*) or generic (X-RateLimit-*) headers.
+        """
+        limit = headers.get("X-HubSpot-RateLimit-Max") or headers.get("X-RateLimit-Limit")
+        remaining = headers.get("X-HubSpot-RateLimit-Remaining") or headers.get("X-RateLimit-Remaining")
+        interval_ms = headers.get("X-HubSpot-RateLimit-Interval-Milliseconds")
+        try:
+            if limit:
+                self.capacity = max(float(limit), 1.0)
+            if interval_ms:
+                self.interval = max(float(interval_ms) / 1000, 0.001)
+            if remaining is not None:
+                self._refill()
+                # The upstream counter also includes other clients of the same account
+                self.tokens = min(self.tokens, float(remaining))
+        except ValueError:
+            pass
+
+    def penalize(self, retry_after: float):
+        """
+        After a 429, stop issuing calls until retry_after has passed.
+        """
+        self._refill()
+        self.tokens = min(self.tokens, 0.0)
+        self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+
+    def stats(self) -> dict:
+        self._refill()
+        return {
+            "capacity": self.capacity,
+            "interval": self.interval,
+            "available": round(max(self.tokens, 0.0), 2),
+            "queued": max(int(-self.tokens), 0),
+            "throttled": self.throttled,
+            "rejected": self.rejected,
+        }
+
+class RateLimiter:
+    """
+    One token bucket per (upstream, endpoint class).
+    """
+    def __init__(self, defaults: Dict[Tuple[str, str], Tuple[float, float]], fallback: Dict[str, Tuple[float, float]], max_wait: float):
+        self.defaults = defaults
+        self.fallback = fallback
+        self.max_wait = max_wait
+        self._buckets: Dict[Tuple[str, str], TokenBucket] = {}
+
+    def bucket(self, upstream: str, endpoint_class: str) -> TokenBucket:
+        key = (upstream, endpoint_class)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            capacity, interval = self.defaults.get(key) or self.fallback[upstream]
+            bucket = TokenBucket(f"{upstream}/{endpoint_class}", capacity, interval)
+            self._buckets[key] = bucket
+        return bucket
+
+    async def request(self, client: httpx.AsyncClient, upstream: str, endpoint_class: str,
+                      method: str, url: str, **kwargs) -> httpx.Response:
+        """
+        Send a request within the bucket's budget. 429 responses are retried after
+        Retry-After as long as we stay within max_wait; otherwise the 429 is returned.
+        """
+        bucket = self.bucket(upstream, endpoint_class)
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            await bucket.acquire(deadline)
+            response = await client.request(method, url, **kwargs)
+            bucket.update_from_headers(response.headers)
+            if response.status_code != 429:
+                return response
+
+            retry_after = parse_retry_after(response.headers) or bucket.interval
+            bucket.penalize(retry_after)
+            logger.warning(f"Rate limited by {bucket.name} (429). Backing off {retry_after:.1f}s.")
+            if time.monotonic() + retry_after > deadline:
+                return response
+
+    def stats(self) -> dict:
+        return {bucket.name: bucket.stats() for bucket in self._buckets.values()}
+
+rate_limiter = RateLimiter(
+    defaults={
+        (HUBSPOT, SEARCH): (settings.HUBSPOT_SEARCH_RATE_LIMIT_MAX, settings.HUBSPOT_SEARCH_RATE_LIMIT_INTERVAL),
+    },
+    fallback={
+        HUBSPOT: (settings.HUBSPOT_RATE_LIMIT_MAX, settings.HUBSPOT_RATE_LIMIT_INTERVAL),
+        LANDBOT: (settings.LANDBOT_RATE_LIMIT_MAX, settings.LANDBOT_RATE_LIMIT_INTERVAL),
+    },
+    max_wait=settings.RATE_LIMIT_MAX_WAIT,
+)
@@ -0,0 +1,169 @@
+import asyncio
+import json
+import logging
+import random
+import sqlite3
+import time
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Optional
+import httpx
+from src.config import settings
+from src.services.rate_limiter import parse_retry_after
+from src.services import metrics
+
+logger = logging.getLogger(__name__)
+
+# Set by the outbox consumer for the job being processed
+message_deadline: ContextVar[Optional[float]] = ContextVar("message_deadline", default=None)
+idempotency_scope: ContextVar[Optional[str]] = ContextVar("idempotency_scope", default=None)
+
+# The upstream did not process the request; safe to retry any method
+SAFE_STATUSES = {429, 502, 503}
+SAFE_EXCEPTIONS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+# The upstream may or may not have processed the request; only retried for idempotent calls
+AMBIGUOUS_STATUSES = {408, 500, 504}
+AMBIGUOUS_EXCEPTIONS = (httpx.ReadTimeout, httpx.WriteTimeout, httpx.RemoteProtocolError, httpx.ReadError, httpx.WriteError)
+
+class AmbiguousDeliveryError(Exception):
+    """
+    A non-idempotent call failed in a way where it may already have been applied.
+    It is not retried in place; the outbox re-drives the whole job after a backoff,
+    since a rare duplicate is better than dropping the customer's message.
+    """
+
+def is_retryable(error: Exception) -> bool:
+    """
+    Whether a failed job is worth running again later.
+    """
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status in SAFE_STATUSES or status in AMBIGUOUS_STATUSES
+    return True
+
+def _backoff(attempt: int) -> float:
+    # Full jitter: spreads retries from many workers instead of synchronising them
+    return random.uniform(0, min(settings.RETRY_MAX_DELAY, settings.RETRY_BASE_DELAY * (2 ** attempt)))
+
+def _remaining() -> Optional[float]:
+    deadline = message_deadline.get()
+    return deadline - time.time() if deadline is not None else None
+
+async def send_with_retry(send: Callable[[], Awaitable[httpx.Response]], idempotent: bool, name: str,
+                          operation: str = "other") -> httpx.Response:
+    """
+    Run send() and retry transient failures with jittered exponential backoff,
+    honouring Retry-After and the current message deadline.
+
+    Non-idempotent calls are only retried when the upstream did not process them
+    (connection failures, 429, 502, 503); other failures after the request was
+    sent raise AmbiguousDeliveryError for the caller's job to be re-driven. Returns the last response; callers still
+    call raise_for_status().
+    """
+    attempt = 0
+    while True:
+        error: Optional[Exception] = None
+        response: Optional[httpx.Response] = None
+        try:
+            response = await send()
+        except httpx.TransportError as e:
+            error = e
+
+        if response is not None:
+            status = response.status_code
+            if status in SAFE_STATUSES or (idempotent and status in AMBIGUOUS_STATUSES):
+                delay = parse_retry_after(response.headers) or _backoff(attempt)
+            elif status in AMBIGUOUS_STATUSES:
+                raise AmbiguousDeliveryError(f"{name}: HTTP {status}; the request may have been applied, not retrying in place")
+            else:
+                return response
+        elif isinstance(error, SAFE_EXCEPTIONS) or (idempotent and isinstance(error, AMBIGUOUS_EXCEPTIONS)):
+            delay = _backoff(attempt)
+        elif isinstance(error, AMBIGUOUS_EXCEPTIONS):
+            raise AmbiguousDeliveryError(f"{name}: {error!r} after the request was sent; not retrying in place") from error
+        else:
+            raise error
+
+        attempt += 1
+        remaining = _remaining()
+        if attempt >= settings.RETRY_MAX_ATTEMPTS or (remaining is not None and delay > remaining):
+            if response is not None:
+                return response
+            raise error
+
+        reason = f"HTTP {response.status_code}" if response is not None else repr(error)
+        metrics.upstream_retries.labels(operation).inc()
+        logger.warning(f"{name} failed ({reason}). Retry {attempt} in {delay:.2f}s.")
+        await asyncio.sleep(delay)
+
+class IdempotencyStore:
+    """
+    Records side effects (publish, send) already completed for a job, so a job
+    that is re-run after a later failure or a crash does not repeat them.
+    Records older than `ttl` (well past any message deadline) are pruned hourly.
+    """
+    PRUNE_INTERVAL = 3600
+
+    def __init__(self, db_path: str, ttl: float = 86400):
+        self.db_path = db_path
+        self.ttl = ttl
+        self._db: Optional[sqlite3.Connection] = None
+        self._pruned_at = 0.0
+        self.skipped = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            # record() commits on the event loop: in WAL mode NORMAL skips the fsync per commit
+            # and still survives a process crash, which is what re-run jobs recover from
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("PRAGMA busy_timeout=5000")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS idempotency (key TEXT PRIMARY KEY, result TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._prune()
+        return self._db
+
+    def _prune(self):
+        now = time.time()
+        self._db.execute("DELETE FROM idempotency WHERE created_at < ?", (now - self.ttl,))
+        self._db.commit()
+        self._pruned_at = now
+
+    def _key(self, operation: str) -> Optional[str]:
+        scope = idempotency_scope.get()
+        return f"{scope}:{operation}" if scope else None
+
+    def lookup(self, operation: str) -> Optional[Any]:
+        """
+        Result of operation if it already succeeded for the current job, else None.
+        """
+        key = self._key(operation)
+        if not key:
+            return None
+        row = self._connect().execute("SELECT result FROM idempotency WHERE key = ?", (key,)).fetchone()
+        if row:
+            self.skipped += 1
+            return json.loads(row[0])
+        return None
+
+    def record(self, operation: str, result: Any):
+        key = self._key(operation)
+        if not key:
+            return
+        db = self._connect()
+        now = time.time()
+        db.execute(
+            "INSERT OR REPLACE INTO idempotency (key, result, created_at) VALUES (?, ?, ?)",
+            (key, json.dumps(result), now)
+        )
+        db.commit()
+        if now - self._pruned_at > self.PRUNE_INTERVAL:
+            self._prune()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+idempotency = IdempotencyStore(settings.IDEMPOTENCY_DB, ttl=settings.IDEMPOTENCY_TTL)
@@ -0,0 +1,69 @@
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+from src.config import settings
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class ThreadState:
+    ticket_id: Optional[str] = None
+    contact_id: Optional[str] = None
+    associated: bool = False
+    pending: bool = False
+
+class ThreadStateStore:
+    """
+    Bounded LRU map of HubSpot thread_id -> ticket association state.
+    Once a thread is linked to its contact, later messages skip the ticket lookup entirely.
+    """
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self._threads: "OrderedDict[str, ThreadState]" = OrderedDict()
+
+    def get(self, thread_id: str) -> Optional[ThreadState]:
+        state = self._threads.get(thread_id)
+        if state:
+            self._threads.move_to_end(thread_id)
+        return state
+
+    def _put(self, thread_id: str, state: ThreadState):
+        self._threads[thread_id] = state
+        self._threads.move_to_end(thread_id)
+        while len(self._threads) > self.max_size:
+            self._threads.popitem(last=False)
+
+    def needs_association(self, thread_id: str, contact_id: str) -> bool:
+        """
+        True if this thread still has to be linked to contact_id and no lookup is in flight.
+        """
+        state = self.get(thread_id)
+        if not state:
+            return True
+        if state.pending:
+            return False
+        return not (state.associated and state.contact_id == contact_id)
+
+    def mark_pending(self, thread_id: str, contact_id: str):
+        state = self.get(thread_id) or ThreadState()
+        state.contact_id = contact_id
+        state.pending = True
+        self._put(thread_id, state)
+
+    def mark_associated(self, thread_id: str, ticket_id: str, contact_id: str):
+        self._put(thread_id, ThreadState(ticket_id=ticket_id, contact_id=contact_id, associated=True))
+
+    def clear_pending(self, thread_id: str):
+        """
+        Release a failed lookup so the next message on the thread can try again.
+        """
+        state = self.get(thread_id)
+        if state:
+            state.pending = False
+
+    def stats(self) -> dict:
+        associated = sum(1 for state in self._threads.values() if state.associated)
+        return {"size": len(self._threads), "associated": associated}
+
+thread_state = ThreadStateStore(max_size=settings.THREAD_STATE_SIZE)
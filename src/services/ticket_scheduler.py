@@ -0,0 +1,147 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional
+from src.config import settings
+from src.services.hubspot_service import hubspot_service
+from src.services.thread_state import thread_state
+from src.services.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class PendingLookup:
+    contact_id: str
+    attempt: int
+    deadline: float
+    # Trace of the message that triggered the lookup
+    trace: Optional[str] = None
+
+class TicketAssociationScheduler:
+    """
+    Single background task that retries thread -> ticket lookups with exponential backoff.
+
+    Pending lookups sit in a min-heap ordered by due time (one entry per thread).
+    Everything that comes due in the same tick is looked up together, and the
+    number of waiting threads is capped so memory stays bounded.
+    """
+    def __init__(self, initial_delay: float = 5, max_delay: float = 60, deadline: float = 300,
+                 max_pending: int = 10000, batch_size: int = 50):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self._heap: list = []
+        self._pending: Dict[str, PendingLookup] = {}
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.dropped = 0
+        self.expired = 0
+
+    def schedule(self, thread_id: str, contact_id: str) -> bool:
+        """
+        Queue a lookup for thread_id. Returns False if the queue is full.
+        """
+        if thread_id in self._pending:
+            return True
+        if len(self._pending) >= self.max_pending:
+            self.dropped += 1
+            logger.warning(f"Ticket lookup queue full ({self.max_pending}). Dropping thread {thread_id}.")
+            return False
+
+        now = time.monotonic()
+        self._pending[thread_id] = PendingLookup(
+            contact_id=contact_id, attempt=0, deadline=now + self.deadline, trace=tracer.context()
+        )
+        thread_state.mark_pending(thread_id, contact_id)
+        self._push(thread_id, now + self.initial_delay)
+        return True
+
+    def _push(self, thread_id: str, due_at: float):
+        heapq.heappush(self._heap, (due_at, next(self._seq), thread_id))
+        # Wake the loop in case this entry is due before the one it is sleeping on
+        self._wakeup.set()
+
+    def _pop_due(self) -> list:
+        now = time.monotonic()
+        due = []
+        while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+            _, _, thread_id = heapq.heappop(self._heap)
+            if thread_id in self._pending:
+                due.append(thread_id)
+        return due
+
+    async def _lookup(self, thread_id: str):
+        lookup = self._pending.get(thread_id)
+        if not lookup:
+            return
+
+        with tracer.resume(lookup.trace, "ticket_lookup", thread_id=thread_id, attempt=lookup.attempt + 1):
+            ticket_id = await hubspot_service.get_thread_associated_ticket(thread_id)
+            associated = bool(ticket_id) and await hubspot_service.associate_contact_with_ticket(lookup.contact_id, ticket_id)
+        if associated:
+            thread_state.mark_associated(thread_id, ticket_id, lookup.contact_id)
+            del self._pending[thread_id]
+            return
+
+        lookup.attempt += 1
+        delay = min(self.initial_delay * (2 ** lookup.attempt), self.max_delay)
+        due_at = time.monotonic() + delay
+        if due_at > lookup.deadline:
+            self.expired += 1
+            logger.info(f"No auto-ticket found for thread {thread_id} after {lookup.attempt} attempts. Native association might handle it if phone matched.")
+            del self._pending[thread_id]
+            thread_state.clear_pending(thread_id)
+            return
+
+        logger.info("No ticket for thread %s yet. Retrying in %.1fs (attempt %s).", thread_id, delay, lookup.attempt, extra={"sample_every": 10})
+        self._push(thread_id, due_at)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            due = self._pop_due()
+            if due:
+                results = await asyncio.gather(*(self._lookup(thread_id) for thread_id in due), return_exceptions=True)
+                for thread_id, result in zip(due, results):
+                    if isinstance(result, Exception):
+                        logger.error(f"Ticket lookup for thread {thread_id} failed: {result}")
+                        self._pending.pop(thread_id, None)
+                        thread_state.clear_pending(thread_id)
+                continue
+
+            timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        return {"pending": len(self._pending), "dropped": self.dropped, "expired": self.expired}
+
+ticket_scheduler = TicketAssociationScheduler(
+    initial_delay=settings.TICKET_LOOKUP_INITIAL_DELAY,
+    max_delay=settings.TICKET_LOOKUP_MAX_DELAY,
+    deadline=settings.TICKET_LOOKUP_DEADLINE,
+    max_pending=settings.TICKET_LOOKUP_MAX_PENDING,
+    batch_size=settings.TICKET_LOOKUP_BATCH_SIZE,
+)
@@ -0,0 +1,93 @@
+import abc
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Optional, Tuple
+from src.config import settings
+
+logger = logging.getLogger(__name__)
+
+class TokenStore(abc.ABC):
+    """
+    Where the HubSpot access token lives between refreshes.
+    Expiry is stored as a UNIX timestamp so it can be shared between processes.
+    """
+    @abc.abstractmethod
+    def load(self) -> Optional[Tuple[str, float]]:
+        ...
+
+    @abc.abstractmethod
+    def save(self, access_token: str, expires_at: float):
+        ...
+
+    @asynccontextmanager
+    async def lock(self):
+        """
+        Exclusive lock held while refreshing, so only one holder talks to /oauth/v1/token.
+        """
+        yield
+
+class MemoryTokenStore(TokenStore):
+    """
+    Per-process store. Each worker refreshes on its own.
+    """
+    def __init__(self):
+        self._token: Optional[Tuple[str, float]] = None
+
+    def load(self) -> Optional[Tuple[str, float]]:
+        return self._token
+
+    def save(self, access_token: str, expires_at: float):
+        self._token = (access_token, expires_at)
+
+class FileTokenStore(TokenStore):
+    """
+    JSON file shared by every worker on the node, guarded by an flock'ed sidecar file.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.lock_path = f"{path}.lock"
+
+    def load(self) -> Optional[Tuple[str, float]]:
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            return data["access_token"], float(data["expires_at"])
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError) as e:
+            logger.warning(f"Ignoring unreadable token store {self.path}: {e}")
+            return None
+
+    def save(self, access_token: str, expires_at: float):
+        # Write-then-rename so readers never see a half-written file
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"access_token": access_token, "expires_at": expires_at}, f)
+        os.replace(tmp_path, self.path)
+
+    @asynccontextmanager
+    async def lock(self):
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            # flock blocks, so wait for it off the event loop
+            await asyncio.to_thread(fcntl.flock, fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+def build_token_store() -> TokenStore:
+    if settings.HUBSPOT_TOKEN_STORE == "memory":
+        return MemoryTokenStore()
+    if settings.HUBSPOT_TOKEN_STORE == "file":
+        return FileTokenStore(settings.HUBSPOT_TOKEN_STORE_PATH)
+    raise ValueError(f"Unknown HUBSPOT_TOKEN_STORE: {settings.HUBSPOT_TOKEN_STORE}")
+
+def token_is_fresh(token: Optional[Tuple[str, float]], margin: float = 0) -> bool:
+    return bool(token) and token[1] > time.time() + margin
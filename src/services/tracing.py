@@ -0,0 +1,277 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional
+from src.config import settings
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_PATH = "/webhook"
+
+@dataclass(slots=True)
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str]
+    start: float
+    end: Optional[float] = None
+    attributes: dict = field(default_factory=dict)
+    error: Optional[str] = None
+
+    @property
+    def duration_ms(self) -> float:
+        return round(((self.end or time.time()) - self.start) * 1000, 3)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration_ms": self.duration_ms,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+def current_trace_id() -> Optional[str]:
+    """
+    Correlation ID of the message being handled, if any.
+    """
+    span = _current_span.get()
+    return span.trace_id if span else None
+
+def _percentile(values: List[float], fraction: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+class MemoryExporter:
+    """
+    Keeps the last `size` spans in memory for the /debug/traces endpoint.
+    """
+    def __init__(self, size: int = 5000):
+        self.spans: deque = deque(maxlen=size)
+
+    def export(self, span: Span):
+        self.spans.append(span)
+
+    def traces(self, limit: int = 20, trace_id: Optional[str] = None) -> list:
+        """
+        Most recent traces first, each with its spans and end-to-end duration.
+        """
+        grouped: Dict[str, List[Span]] = {}
+        for span in reversed(self.spans):
+            if trace_id is None or span.trace_id == trace_id:
+                grouped.setdefault(span.trace_id, []).append(span)
+            if len(grouped) > limit:
+                break
+        traces = []
+        for spans in list(grouped.values())[:limit]:
+            spans.sort(key=lambda span: span.start)
+            start = spans[0].start
+            end = max(span.end for span in spans)
+            traces.append({
+                "trace_id": spans[0].trace_id,
+                "duration_ms": round((end - start) * 1000, 3),
+                "spans": [span.to_dict() for span in spans],
+            })
+        return traces
+
+    def summary(self) -> dict:
+        """
+        p50/p95/p99 per span name and end-to-end per trace, over the buffered spans.
+        Shows which hop dominates the tail.
+        """
+        by_name: Dict[str, List[float]] = {}
+        bounds: Dict[str, List[float]] = {}
+        webhook_traces = set()
+        for span in self.spans:
+            by_name.setdefault(span.name, []).append(span.duration_ms)
+            first_start, last_end = bounds.get(span.trace_id, (span.start, span.end))
+            bounds[span.trace_id] = [min(first_start, span.start), max(last_end, span.end)]
+            if span.parent_id is None and WEBHOOK_PATH in span.name:
+                webhook_traces.add(span.trace_id)
+        # Only traces of received messages; background jobs start their own traces
+        by_name["end_to_end"] = [
+            round((end - start) * 1000, 3) for trace_id, (start, end) in bounds.items() if trace_id in webhook_traces
+        ]
+        summary = {}
+        for name, durations in by_name.items():
+            if not durations:
+                continue
+            durations.sort()
+            summary[name] = {
+                "count": len(durations),
+                "p50_ms": _percentile(durations, 0.50),
+                "p95_ms": _percentile(durations, 0.95),
+                "p99_ms": _percentile(durations, 0.99),
+            }
+        return summary
+
+class JsonlExporter:
+    """
+    Appends one JSON line per span to a file, written by a background thread
+    so request handling never waits on disk.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+
+    def export(self, span: Span):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._write, name="trace-writer", daemon=True)
+            self._thread.start()
+        self._queue.put(span)
+
+    def _write(self):
+        with open(self.path, "a", encoding="utf-8") as file:
+            while True:
+                span = self._queue.get()
+                if span is None:
+                    return
+                lines = [span]
+                # Drain whatever else is queued into the same write
+                while not self._queue.empty():
+                    span = self._queue.get()
+                    if span is None:
+                        break
+                    lines.append(span)
+                file.write("".join(json.dumps(line.to_dict(), default=str) + "\n" for line in lines))
+                file.flush()
+                if span is None:
+                    return
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+            self._thread = None
+
+class Tracer:
+    """
+    Minimal in-process tracer. A trace starts when a webhook receives a message;
+    its ID is the correlation ID that appears in logs and follows the message
+    through the outbox to every upstream call made for it. Finished spans go to
+    the configured exporters.
+    """
+    def __init__(self, exporters: Optional[list] = None):
+        self.exporters = exporters or []
+
+    def exporter(self, kind: type):
+        return next((exporter for exporter in self.exporters if isinstance(exporter, kind)), None)
+
+    def _finish(self, span: Span):
+        span.end = time.time()
+        for exporter in self.exporters:
+            exporter.export(span)
+
+    @contextmanager
+    def span(self, name: str, parent: Optional[Span] = None, **attributes) -> Iterator[Span]:
+        """
+        Run the block in a child span of the current (or given) span; a new trace if there is none.
+        """
+        parent = parent or _current_span.get()
+        span = Span(
+            name=name,
+            trace_id=parent.trace_id if parent else os.urandom(16).hex(),
+            span_id=os.urandom(8).hex(),
+            parent_id=parent.span_id if parent else None,
+            start=time.time(),
+            attributes=attributes,
+        )
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = repr(e)
+            raise
+        finally:
+            _current_span.reset(token)
+            self._finish(span)
+
+    def context(self) -> Optional[str]:
+        """
+        The current span as "trace_id:span_id", to continue the trace in another task or process.
+        """
+        span = _current_span.get()
+        return f"{span.trace_id}:{span.span_id}" if span else None
+
+    @staticmethod
+    def _parent(context: Optional[str]) -> Optional[Span]:
+        if not context or ":" not in context:
+            return None
+        trace_id, span_id = context.split(":", 1)
+        return Span(name="", trace_id=trace_id, span_id=span_id, parent_id=None, start=0)
+
+    @contextmanager
+    def resume(self, context: Optional[str], name: str, **attributes) -> Iterator[Span]:
+        """
+        Continue a trace saved with context(), e.g. when an outbox job runs.
+        """
+        with self.span(name, parent=self._parent(context), **attributes) as span:
+            yield span
+
+    def record(self, name: str, start: float, context: Optional[str] = None, **attributes):
+        """
+        Export a span that already happened, from start until now (e.g. time spent queued).
+        """
+        parent = self._parent(context) or _current_span.get()
+        if parent is None or not self.exporters:
+            return
+        self._finish(Span(
+            name=name, trace_id=parent.trace_id, span_id=os.urandom(8).hex(),
+            parent_id=parent.span_id, start=start, attributes=attributes,
+        ))
+
+    def close(self):
+        for exporter in self.exporters:
+            if isinstance(exporter, JsonlExporter):
+                exporter.close()
+
+class TraceMiddleware:
+    """
+    ASGI middleware opening the root span of each webhook request and returning
+    its ID in the X-Trace-Id header.
+    """
+    def __init__(self, app, tracer: "Tracer"):
+        self.app = app
+        self.tracer = tracer
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(WEBHOOK_PATH):
+            await self.app(scope, receive, send)
+            return
+
+        with self.tracer.span(f"{scope['method']} {scope['path']}") as span:
+            trace_header = (b"x-trace-id", span.trace_id.encode())
+
+            async def send_with_trace(message):
+                if message["type"] == "http.response.start":
+                    message["headers"] = [*message.get("headers", []), trace_header]
+                    span.attributes["status"] = message["status"]
+                await send(message)
+
+            await self.app(scope, receive, send_with_trace)
+
+def build_tracer() -> Tracer:
+    exporters = []
+    for name in filter(None, (name.strip() for name in settings.TRACE_EXPORTERS.split(","))):
+        if name == "memory":
+            exporters.append(MemoryExporter(settings.TRACE_BUFFER_SIZE))
+        elif name == "jsonl":
+            exporters.append(JsonlExporter(settings.TRACE_FILE))
+        else:
+            logger.warning(f"Unknown trace exporter '{name}', ignoring it.")
+    return Tracer(exporters)
+
+tracer = build_tracer()